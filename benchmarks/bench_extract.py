@@ -0,0 +1,186 @@
+"""
+Times each stage of ExtractTrialData on synthetic c3d files.
+
+Stages: decode (ezc3d), EventData, PointsData, AnalogsData, SliceKinematics, SliceEMG and
+MSAInputData, plus the whole ExtractTrialData call. Cases are every combination of the EMG
+systems and recording lengths given. Results can be written as JSON and compared with an
+earlier run to spot regressions. --float32 adds the accuracy and memory of float32 extraction.
+
+    python benchmarks/bench_extract.py --frames 600 6000 --output new.json --compare old.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+
+import numpy as np
+import ezc3d
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'c3dgait'))
+import c3dtrial
+from c3dtrial import EventData, PointsData, AnalogsData, ExtractTrialData
+from synthetic_c3d import WriteSyntheticC3D, EMG_DESCRIPTIONS
+
+STAGES = ('decode', 'EventData', 'PointsData', 'AnalogsData', 'SliceKinematics', 'SliceEMG', 'MSAInputData', 'ExtractTrialData')
+
+def RunStages(path):
+    """
+    Runs the extraction stages of a file once.
+
+    :param path(string): c3d file
+    :return: timings(dict): Stage -> seconds
+    """
+    timings = {}
+
+    def timed(stage, func):
+        start = time.perf_counter()
+        result = func()
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    c3dobj = timed('decode', lambda: ezc3d.c3d(path))
+    parameters = c3dobj['parameters']
+    header = c3dobj['header']
+
+    events = timed('EventData', lambda: EventData(parameters['EVENT']['TIMES']['value'][1],
+        parameters['EVENT']['LABELS']['value'], parameters['EVENT']['CONTEXTS']['value'],
+        PointsFirstFrame=header['points']['first_frame'], PointsFrequency=header['points']['frame_rate'],
+        AnalogsFirstFrame=header['analogs']['first_frame'], AnalogsFrequency=header['analogs']['frame_rate']))
+
+    groups = {group.capitalize(): parameters['POINT'][group]['value'] for group in ('ANGLES', 'POWERS', 'MOMENTS', 'FORCES')}
+    points = timed('PointsData', lambda: PointsData(parameters['POINT']['LABELS']['value'], groups,
+        c3dobj['data']['points'], PointsFrequency=header['points']['frame_rate']))
+    analogs = timed('AnalogsData', lambda: AnalogsData(parameters['ANALOG']['LABELS']['value'],
+        parameters['ANALOG']['DESCRIPTIONS']['value'], parameters['ANALOG']['UNITS']['value'],
+        c3dobj['data']['analogs'][0], AnalogsFrequency=header['analogs']['frame_rate']))
+
+    timed('SliceKinematics', lambda: points.SliceKinematics(events.LC_Slice_Points, events.RC_Slice_Points, events.Full_Slice_Points))
+    timed('SliceEMG', lambda: analogs.SliceEMG(events.LC_Slice_Analogs, events.RC_Slice_Analogs, events.Full_Slice_Analogs))
+    timed('MSAInputData', lambda: analogs.MSAInputData(analogs.newEMGLabels))
+
+    timed('ExtractTrialData', lambda: ExtractTrialData(path, lazy=False))
+    return timings
+
+def BenchmarkFile(path, repeat):
+    """
+    Returns the min and median time of each stage over repeated runs.
+
+    :param path(string): c3d file
+    :param repeat(int): Number of runs
+    :return: stages(dict): Stage -> {'min': seconds, 'median': seconds}
+    """
+    runs = []
+    # The library prints warnings (e.g. extra events), keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            runs.append(RunStages(path))
+    return {stage: {'min': min(run[stage] for run in runs), 'median': float(np.median([run[stage] for run in runs]))}
+        for stage in STAGES}
+
+def TrialBytes(trial):
+    # Bytes of the channel data and datasets held by an extracted trial
+    arrays = [trial.KinematicData, trial.PowerData, trial.MomentData, trial.ForceData, trial.EMGData, trial.ForceplateData,
+        trial.OtherAnalogData, trial.Kinematics_LC, trial.Kinematics_RC, trial.Kinematics_Full, trial.gpskinematics,
+        trial.EMG_LC, trial.EMG_RC, trial.EMG_Full, trial.MSAData]
+    return int(sum(getattr(array, 'data', array).nbytes for array in arrays))
+
+def PrecisionReport(path):
+    """
+    Compares float32 extraction (ExtractTrialData(dtype=np.float32)) with the default float64.
+
+    :param path(string): c3d file
+    :return: report(dict): Largest absolute gpskinematics error (degrees), largest MSAData error relative to
+        the signal range, trial memory in both modes and the float32 extraction time
+    """
+    trials = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for dtype in (np.float64, np.float32):
+            start = time.perf_counter()
+            trial = ExtractTrialData(path, lazy=False, dtype=dtype)
+            trial.MSAInputData(trial.newEMGLabels)
+            trials[dtype] = (trial, time.perf_counter() - start)
+
+    double, single = trials[np.float64][0], trials[np.float32][0]
+    msa = np.abs(double.MSAData - single.MSAData).max()/np.ptp(double.MSAData)
+    return {
+        'gps_max_abs_error': float(np.abs(double.gpskinematics.data - single.gpskinematics.data).max()),
+        'msa_max_rel_error': float(msa),
+        'float64_bytes': TrialBytes(double),
+        'float32_bytes': TrialBytes(single),
+        'float32_seconds': trials[np.float32][1],
+    }
+
+def Compare(results, baseline):
+    print(f'\n{"case":<28}{"stage":<18}{"baseline ms":>12}{"now ms":>10}{"ratio":>8}')
+    old = {case['name']: case['stages'] for case in baseline['cases']}
+    for case in results['cases']:
+        if case['name'] not in old:
+            continue
+        for stage in STAGES:
+            if stage not in old[case['name']]:
+                continue
+            before, now = old[case['name']][stage]['median'], case['stages'][stage]['median']
+            flag = '  slower' if now > 1.1*before else ''
+            print(f'{case["name"]:<28}{stage:<18}{before*1e3:>12.2f}{now*1e3:>10.2f}{now/before:>8.2f}{flag}')
+    return
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--systems', nargs='+', choices=sorted(EMG_DESCRIPTIONS), default=sorted(EMG_DESCRIPTIONS))
+    parser.add_argument('--frames', type=int, nargs='+', default=[600, 6000], help='Point frames of each case')
+    parser.add_argument('--point-rate', type=int, default=120)
+    parser.add_argument('--analog-rate', type=int, default=1200)
+    parser.add_argument('--markers', type=int, default=40, help='Marker trajectories besides the model outputs')
+    parser.add_argument('--emg', type=int, default=16, help='EMG channels (capped at the labels known for the system)')
+    parser.add_argument('--events', type=int, default=13)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--float32', action='store_true', help='Also report the accuracy and memory of float32 extraction')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    results = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'c3dgait': c3dtrial.__version__, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'settings': {'point_rate': args.point_rate, 'analog_rate': args.analog_rate, 'markers': args.markers,
+            'emg': args.emg, 'events': args.events, 'repeat': args.repeat},
+        'cases': [],
+    }
+
+    print(f'{"case":<28}' + ''.join(f'{stage[:12]:>13}' for stage in STAGES) + '   (median ms)')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for system in args.systems:
+            for frames in args.frames:
+                name = f'{system}-{frames}'
+                path = WriteSyntheticC3D(os.path.join(tmpdir, f'{name}.c3d'), frames=frames, pointrate=args.point_rate,
+                    analograte=args.analog_rate, markers=args.markers, emg=args.emg, emgsystem=system, events=args.events)
+                stages = BenchmarkFile(path, args.repeat)
+                case = {'name': name, 'system': system, 'frames': frames, 'bytes': os.path.getsize(path), 'stages': stages}
+                if args.float32:
+                    case['float32'] = PrecisionReport(path)
+                results['cases'].append(case)
+                print(f'{name:<28}' + ''.join(f'{stages[stage]["median"]*1e3:>13.2f}' for stage in STAGES))
+
+    if args.float32:
+        print(f'\n{"case":<28}{"gps max err":>14}{"MSA rel err":>14}{"float64 MB":>12}{"float32 MB":>12}')
+        for case in results['cases']:
+            report = case['float32']
+            print(f'{case["name"]:<28}{report["gps_max_abs_error"]:>14.2e}{report["msa_max_rel_error"]:>14.2e}'
+                f'{report["float64_bytes"]/1024**2:>12.2f}{report["float32_bytes"]/1024**2:>12.2f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            Compare(results, json.load(f))
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,60 @@
+"""
+Compares the cycle normalisation engines in c3dtrial.NormaliseCycles.
+
+Reports throughput on a batch of channels and the error against the exact curve, split
+into the cycle edges (first and last 10% of the cycle) and the middle. The test curve is
+not periodic over the cycle, like most joint angles, which is where FFT resampling rings.
+Each engine is scored at the cycle times its own output samples fall on (see OutputTimes).
+
+    python benchmarks/bench_normalise.py --channels 18 --length 121 --samples 51
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'c3dgait'))
+from c3dtrial import NormaliseCycles
+
+def curve(t, phase):
+    # Knee flexion like shape with a different start and end value
+    return 30*np.sin(2*np.pi*t + phase) + 15*t + 5*np.cos(6*np.pi*t)
+
+def OutputTimes(normalisation, length, samples):
+    # Cycle fraction of each output sample, raw sample i is at i/(length-1). Interpolation spans the first to the
+    # last raw sample, scipy.signal.resample places output k at raw sample k*length/samples
+    if normalisation == 'fft':
+        return np.arange(samples)*length/samples/(length - 1)
+    return np.linspace(0, 1, samples)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--channels', type=int, default=18)
+    parser.add_argument('--length', type=int, default=121, help='Samples in the raw cycle')
+    parser.add_argument('--samples', type=int, default=51, help='Samples to normalise to')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    phases = np.linspace(0, np.pi, args.channels)[:, None]
+    raw = curve(np.linspace(0, 1, args.length)[None, :], phases)
+
+    edge = max(int(round(0.1*args.samples)), 1)
+    print(f'{args.channels} channels, {args.length} -> {args.samples} samples')
+    print(f'{"engine":<8}{"us/call":>10}{"edge err":>12}{"mid err":>12}')
+    for normalisation in ('fft', 'linear', 'cubic'):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            out = NormaliseCycles(raw, args.samples, normalisation)
+        elapsed = (time.perf_counter() - start)/args.repeat
+
+        exact = curve(OutputTimes(normalisation, args.length, args.samples)[None, :], phases)
+        error = np.abs(out - exact)
+        edgeErr = max(error[:, :edge].max(), error[:, -edge:].max())
+        midErr = error[:, edge:-edge].max()
+        print(f'{normalisation:<8}{elapsed*1e6:>10.1f}{edgeErr:>12.4f}{midErr:>12.4f}')
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
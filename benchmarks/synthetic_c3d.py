@@ -0,0 +1,136 @@
+"""
+Writes synthetic gait c3d files for the benchmarks.
+
+The files have the layout c3dtrial expects: model outputs listed in POINT:ANGLES/POWERS/
+MOMENTS/FORCES, EMG channels labelled and described as one of the EMG systems in
+c3dtrial.EMG_LABEL_CONVERSION, force plate channels in newtons and alternating foot
+strike/foot off events for both sides.
+
+    python benchmarks/synthetic_c3d.py trial.c3d --frames 2400 --emg-system sys3
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+import ezc3d
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'c3dgait'))
+from c3dtrial import EMG_LABEL_CONVERSION
+
+# ANALOG:DESCRIPTIONS that c3dtrial.AnalogsData.CheckEMGLabelset recognises for each system
+EMG_DESCRIPTIONS = {
+    'delsys': 'Delsys IM EMG',
+    'sys1': 'EMG Channel',
+    'sys2': 'Analog Device::Voltage',
+    'sys3': 'Analog EMG::Voltage',
+}
+
+ANGLES = ['LPelvisAngles', 'RPelvisAngles', 'LHipAngles', 'RHipAngles', 'LKneeAngles', 'RKneeAngles',
+    'LAnkleAngles', 'RAnkleAngles', 'LFootProgressAngles', 'RFootProgressAngles']
+KINETICS = {
+    'POWERS': ['LHipPower', 'RHipPower', 'LKneePower', 'RKneePower', 'LAnklePower', 'RAnklePower'],
+    'MOMENTS': ['LHipMoment', 'RHipMoment', 'LKneeMoment', 'RKneeMoment', 'LAnkleMoment', 'RAnkleMoment'],
+    'FORCES': ['LHipForce', 'RHipForce', 'LKneeForce', 'RKneeForce', 'LAnkleForce', 'RAnkleForce'],
+}
+
+def GaitEvents(duration, events, stride=1.0):
+    """
+    Returns alternating gait events, left foot strike first, centred in the recording.
+
+    :param duration(float): Recording length in seconds
+    :param events(int): Number of events
+    :param stride(float)(optional): Stride time in seconds, shortened if the events do not fit
+    :return: times(list), contexts(list), labels(list)
+    """
+    pattern = [('Left', 'Foot Strike'), ('Right', 'Foot Off'), ('Right', 'Foot Strike'), ('Left', 'Foot Off')]
+    step = min(stride/4, 0.9*duration/max(events, 1))
+    start = (duration - step*(events - 1))/2
+    times = [start + i*step for i in range(events)]
+    contexts = [pattern[i % 4][0] for i in range(events)]
+    labels = [pattern[i % 4][1] for i in range(events)]
+    return times, contexts, labels
+
+def WriteSyntheticC3D(path, frames=600, pointrate=120, analograte=1200, markers=20, emg=16,
+    emgsystem='delsys', forceplates=1, events=7, subject='Synthetic', seed=0):
+    """
+    Writes a synthetic gait trial.
+
+    :param path(string): Output c3d path
+    :param frames(int)(optional): Point frames
+    :param pointrate(int)(optional): Point rate (Hz)
+    :param analograte(int)(optional): Analog rate (Hz), a multiple of the point rate
+    :param markers(int)(optional): Marker trajectories besides the model outputs
+    :param emg(int)(optional): EMG channels, at most the number of labels known for the system
+    :param emgsystem(string)(optional): 'delsys', 'sys1', 'sys2' or 'sys3'
+    :param forceplates(int)(optional): Force plates, 3 force channels each
+    :param events(int)(optional): Gait events, at least 7 for c3dtrial to find a full cycle
+    :param subject(string)(optional): SUBJECTS:NAMES value
+    :param seed(int)(optional): Random seed
+    :return: path(string)
+    """
+    if analograte % pointrate:
+        raise Exception("Analog rate must be a multiple of the point rate")
+    rng = np.random.default_rng(seed)
+    t = np.arange(frames)/pointrate
+
+    kinetics = {group: labels for group, labels in KINETICS.items()}
+    modelLabels = ANGLES + [label for labels in kinetics.values() for label in labels]
+    pointLabels = [f'M{i:03d}' for i in range(markers)] + modelLabels
+
+    points = np.empty((4, len(pointLabels), frames))
+    phase = rng.uniform(0, 2*np.pi, size=(3, len(pointLabels), 1))
+    amplitude = rng.uniform(5, 40, size=(3, len(pointLabels), 1))
+    points[:3] = amplitude*np.sin(2*np.pi*t[None, None, :] + phase)
+    points[3] = 1
+
+    emgLabels = list(EMG_LABEL_CONVERSION[emgsystem])[:emg]
+    forceLabels = [f'Force.F{axis}{plate + 1}' for plate in range(forceplates) for axis in 'xyz']
+    analogLabels = emgLabels + forceLabels
+    ratio = analograte//pointrate
+    analogs = np.empty((1, len(analogLabels), frames*ratio))
+    analogs[0, :len(emgLabels)] = 1e-4*rng.standard_normal((len(emgLabels), frames*ratio))
+    analogs[0, len(emgLabels):] = 400*rng.standard_normal((len(forceLabels), frames*ratio))
+
+    c3dobj = ezc3d.c3d()
+    c3dobj['parameters']['POINT']['RATE']['value'] = [pointrate]
+    c3dobj['parameters']['POINT']['LABELS']['value'] = pointLabels
+    c3dobj.add_parameter('POINT', 'ANGLES', ANGLES)
+    for group, labels in kinetics.items():
+        c3dobj.add_parameter('POINT', group, labels)
+    c3dobj['parameters']['ANALOG']['RATE']['value'] = [analograte]
+    c3dobj['parameters']['ANALOG']['LABELS']['value'] = analogLabels
+    c3dobj['parameters']['ANALOG']['UNITS']['value'] = ['V']*len(emgLabels) + ['N']*len(forceLabels)
+    c3dobj['parameters']['ANALOG']['DESCRIPTIONS']['value'] = [EMG_DESCRIPTIONS[emgsystem]]*len(emgLabels) + ['Force plate']*len(forceLabels)
+    c3dobj['data']['points'] = points
+    c3dobj['data']['analogs'] = analogs
+    c3dobj.add_parameter('SUBJECTS', 'NAMES', [subject])
+
+    times, contexts, labels = GaitEvents(frames/pointrate, events)
+    eventTimes = np.zeros((2, len(times)))
+    eventTimes[1] = times
+    c3dobj.add_parameter('EVENT', 'USED', [len(times)])
+    c3dobj.add_parameter('EVENT', 'TIMES', eventTimes)
+    c3dobj.add_parameter('EVENT', 'CONTEXTS', contexts)
+    c3dobj.add_parameter('EVENT', 'LABELS', labels)
+    c3dobj.write(path)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--point-rate', type=int, default=120)
+    parser.add_argument('--analog-rate', type=int, default=1200)
+    parser.add_argument('--markers', type=int, default=20)
+    parser.add_argument('--emg', type=int, default=16)
+    parser.add_argument('--emg-system', choices=sorted(EMG_DESCRIPTIONS), default='delsys')
+    parser.add_argument('--events', type=int, default=7)
+    args = parser.parse_args(argv)
+
+    WriteSyntheticC3D(args.path, frames=args.frames, pointrate=args.point_rate, analograte=args.analog_rate,
+        markers=args.markers, emg=args.emg, emgsystem=args.emg_system, events=args.events)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
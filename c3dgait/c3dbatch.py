@@ -0,0 +1,787 @@
+import os
+import json
+import glob
+import mmap
+import time
+import pickle
+import hashlib
+import tempfile
+import traceback
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from c3dtrial import ExtractTrialData, ScanTrialMetadata, AnonymisedFilePath
+from c3dreader import RewriteSubjectName
+
+class BatchResult:
+    """Outcome of extracting a single file within a batch."""
+
+    __slots__ = ('path', 'trial', 'error', 'errortype')
+
+    def __init__(self, path, trial=None, error=None, errortype=None):
+        """
+        :param path(string): Path of the c3d file
+        :param trial(GaitTrial)(optional): Extracted trial, None if extraction failed
+        :param error(string)(optional): Error message raised while extracting the file
+        :param errortype(string)(optional): Name of the exception class raised
+        :return: None
+        """
+        self.path = path
+        self.trial = trial
+        self.error = error
+        self.errortype = errortype
+        return
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return f'BatchResult({self.path!r}, ok)'
+        return f'BatchResult({self.path!r}, {self.errortype}: {self.error})'
+
+def FindC3DFiles(source, recursive=True):
+    """
+    Returns a sorted list of c3d files from a directory, glob pattern, single file or list of paths.
+
+    :param source(string or list): Directory, glob pattern, file path or list of file paths
+    :param recursive(bool)(optional): Search sub-directories when a directory is given
+    :return: paths(list): Paths of the c3d files found
+    """
+    if isinstance(source, (list, tuple)):
+        return list(source)
+
+    if os.path.isdir(source):
+        pattern = os.path.join(source, '**', '*.c3d') if recursive else os.path.join(source, '*.c3d')
+        paths = glob.glob(pattern, recursive=recursive)
+        # Capture upper case extensions on case sensitive file systems
+        pattern = os.path.join(source, '**', '*.C3D') if recursive else os.path.join(source, '*.C3D')
+        paths += glob.glob(pattern, recursive=recursive)
+    elif os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = glob.glob(source, recursive=True)
+
+    return sorted(set(paths))
+
+# Scratch files holding worker results, in memory backed storage where available
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Arrays smaller than this are sent with the pickled trial rather than through the scratch file
+SHARED_MIN_BYTES = 64*1024
+
+def _ScratchPrefix(owner):
+    # Scratch files are named after the pid of the process that reads them, see RemoveScratchFiles
+    return f'c3dgait-{owner}-'
+
+class SharedTrial:
+    """Trial pickled without its arrays, which were written to a scratch file, see ShareTrial."""
+
+    __slots__ = ('payload', 'path', 'spans')
+
+    def __init__(self, payload, path, spans):
+        """
+        :param payload(bytes): Pickled trial, arrays excluded
+        :param path(string): Scratch file holding the arrays
+        :param spans(list): (offset, bytes) of each array in the scratch file
+        :return: None
+        """
+        self.payload = payload
+        self.path = path
+        self.spans = spans
+        return
+
+def ShareTrial(trial, scratchdir=None, owner=None):
+    """
+    Writes the arrays of a trial to a scratch file and returns a lightweight descriptor to send to another process.
+
+    Uses pickle protocol 5 out-of-band buffers, so arrays are written once to the scratch file instead of
+    being pickled, sent through the pipe and unpickled. Open the result with OpenSharedTrial.
+
+    :param trial(GaitTrial): Extracted trial
+    :param scratchdir(string)(optional): Directory of the scratch file, /dev/shm where available
+    :param owner(int)(optional): Pid of the process that will open the result, defaults to this process
+    :return: shared(SharedTrial): Descriptor, or the trial itself if it holds no large arrays
+    """
+    buffers = []
+
+    def outOfBand(buffer):
+        if buffer.raw().nbytes < SHARED_MIN_BYTES:
+            return True
+        buffers.append(buffer)
+        return False
+
+    payload = pickle.dumps(trial, protocol=5, buffer_callback=outOfBand)
+    if not buffers:
+        return trial
+
+    handle, path = tempfile.mkstemp(prefix=_ScratchPrefix(owner or os.getpid()), suffix='.shm', dir=scratchdir or SCRATCH_DIR)
+    spans = []
+    offset = 0
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            for buffer in buffers:
+                raw = buffer.raw()
+                padding = -offset % 64
+                f.write(bytes(padding))
+                offset += padding
+                f.write(raw)
+                spans.append((offset, raw.nbytes))
+                offset += raw.nbytes
+    except BaseException:
+        os.remove(path)
+        raise
+    return SharedTrial(payload, path, spans)
+
+def OpenSharedTrial(shared):
+    """
+    Rebuilds a trial from a SharedTrial, its arrays are copy-on-write views of the mapped scratch file.
+
+    The scratch file is removed once mapped, the memory is released when the last array is freed.
+
+    :param shared(SharedTrial): Descriptor returned by ShareTrial
+    :return: trial(GaitTrial)
+    """
+    with open(shared.path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    try:
+        os.remove(shared.path)
+    except OSError:
+        pass
+    view = memoryview(mapped)
+    return pickle.loads(shared.payload, buffers=[view[offset:offset + nbytes] for offset, nbytes in shared.spans])
+
+def RemoveScratchFiles(owner=None, scratchdir=None):
+    """
+    Removes scratch files left by ShareTrial, e.g. by a batch that was killed before reading every result.
+
+    :param owner(int)(optional): Remove the files of this pid, by default those of every process no longer running
+    :param scratchdir(string)(optional): Directory of the scratch files, /dev/shm where available
+    :return: removed(int): Number of files removed
+    """
+    scratchdir = scratchdir or SCRATCH_DIR or tempfile.gettempdir()
+    removed = 0
+    for path in glob.glob(os.path.join(scratchdir, _ScratchPrefix('*') + '*.shm')):
+        pid = os.path.basename(path).split('-')[1]
+        if not pid.isdigit():
+            continue
+        if owner is not None:
+            if int(pid) != owner:
+                continue
+        elif _Running(int(pid)):
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+def _Running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def _DiscardFuture(future):
+    # Cancels a result that will never be read, or removes its scratch file once the worker returns it
+    if future is None or future.cancel():
+        return
+    try:
+        result = future.result()
+    except BaseException:
+        return
+    if isinstance(getattr(result, 'trial', None), SharedTrial):
+        try:
+            os.remove(result.trial.path)
+        except OSError:
+            pass
+
+def ExtractFileSafe(path, extract=ExtractTrialData, shared=False, owner=None, **kwargs):
+    """
+    Extracts a single file, capturing any exception in the returned BatchResult rather than raising.
+
+    :param path(string): Path to the c3d file
+    :param extract(callable)(optional): Function used to extract the trial, called as extract(path, **kwargs)
+    :param shared(bool)(optional): Return the trial as a SharedTrial (see ShareTrial), for results sent back from worker processes
+    :param owner(int)(optional): Pid of the process reading the SharedTrial, see ShareTrial
+    :return: result(BatchResult): Extracted trial or the error raised
+    """
+    try:
+        trial = extract(path, **kwargs)
+        if shared:
+            trial = ShareTrial(trial, owner=owner)
+    except Exception as err:
+        msg = str(err) or traceback.format_exc(limit=1).strip()
+        return BatchResult(path, error=msg, errortype=type(err).__name__)
+    return BatchResult(path, trial=trial)
+
+def ExtractBatchData(source, workers=None, ordered=True, recursive=True, maxpending=None, extract=ExtractTrialData, shared=False, **kwargs):
+    """
+    Extracts every c3d file in source across a process pool, yielding a BatchResult per file.
+
+    A file that fails to extract (e.g. "File has not been evented") is reported in its
+    BatchResult and does not stop the remaining files.
+
+    :param source(string or list): Directory, glob pattern, file path or list of file paths
+    :param workers(int)(optional): Number of worker processes, defaults to the cpu count. 0 or 1 runs in this process
+    :param ordered(bool)(optional): Yield results in input order, otherwise as they complete
+    :param recursive(bool)(optional): Search sub-directories when a directory is given
+    :param maxpending(int)(optional): Maximum files submitted to the pool at once, defaults to 4 per worker
+    :param extract(callable)(optional): Function used to extract each file, must be picklable
+    :param shared(bool)(optional): Send the trial arrays back from the workers through scratch files rather than pickling them, see ShareTrial.
+        Scratch files left by killed runs are removed first (see RemoveScratchFiles)
+    :param kwargs: Passed on to extract for every file
+    :return: results(generator): BatchResult per file
+    """
+    paths = FindC3DFiles(source, recursive=recursive)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    shared = shared and workers > 1
+    if shared:
+        RemoveScratchFiles()
+    task = partial(ExtractFileSafe, extract=extract, shared=shared, owner=os.getpid(), **kwargs)
+
+    if workers <= 1:
+        for path in paths:
+            yield task(path)
+        return
+
+    results = _RunPool(task, paths, workers, ordered=ordered, maxpending=maxpending)
+    try:
+        for path, future in results:
+            yield _FutureResult(path, future)
+    finally:
+        results.close()
+    return
+
+def _RunPool(task, items, workers, ordered=True, maxpending=None):
+    # Submits task(item) to a process pool a window at a time, yielding (item, future) as each future is done.
+    # A worker that dies (e.g. a segfault in the decoder) breaks the pool and fails every call in flight, those
+    # items are re-run one at a time in a new pool (see _RerunAlone) so only the item that kills it is failed.
+    # Closing the generator early discards the results still pending, removing their scratch files
+    if maxpending is None:
+        maxpending = 4*workers
+
+    itemiter = iter(items)
+    pending = deque()
+    pool = ProcessPoolExecutor(max_workers=workers)
+
+    def submit():
+        for item in itemiter:
+            entry = [item, None, False]
+            pending.append(entry)
+            try:
+                entry[1] = pool.submit(task, item)
+            except BrokenProcessPool:
+                return
+            if len(pending) >= maxpending:
+                return
+
+    def broken(entry):
+        # Not submitted, or failed by the pool breaking, and not yet re-run alone
+        return entry[1] is None or (not entry[2] and _IsBroken(entry[1]))
+
+    def recover():
+        nonlocal pool
+        pool.shutdown(wait=True)
+        suspects = [entry for entry in pending if broken(entry)]
+        pool, futures = _RerunAlone(task, [((entry[0],), {}) for entry in suspects], workers)
+        for entry, future in zip(suspects, futures):
+            entry[1], entry[2] = future, True
+
+    try:
+        submit()
+        while pending:
+            if pending[-1][1] is None:
+                recover()
+            if ordered:
+                wait([pending[0][1]])
+                if broken(pending[0]):
+                    recover()
+                item, future, _ = pending.popleft()
+                yield item, future
+            else:
+                done, _ = wait([entry[1] for entry in pending], return_when=FIRST_COMPLETED)
+                if any(broken(entry) for entry in pending if entry[1] in done):
+                    recover()
+                    continue
+                for entry in [entry for entry in pending if entry[1] in done]:
+                    pending.remove(entry)
+                    yield entry[0], entry[1]
+            submit()
+    finally:
+        for entry in pending:
+            _DiscardFuture(entry[1])
+        pool.shutdown(wait=True)
+    return
+
+def _IsBroken(future):
+    return future.done() and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+
+def _RerunAlone(task, calls, workers):
+    # Runs each (args, kwargs) call that was in flight when the pool broke alone in a new pool, so only a call that
+    # kills the pool again fails (with BrokenProcessPool). Returns the new pool and a done future per call
+    pool = ProcessPoolExecutor(max_workers=workers)
+    futures = []
+    for args, kwargs in calls:
+        future = pool.submit(task, *args, **kwargs)
+        wait([future])
+        if _IsBroken(future):
+            pool.shutdown(wait=True)
+            pool = ProcessPoolExecutor(max_workers=workers)
+        futures.append(future)
+    return pool, futures
+
+def _FutureResult(path, future):
+    # A worker that died fails its future with BrokenProcessPool (see _RunPool) rather than raising in ExtractFileSafe
+    try:
+        result = future.result()
+        if isinstance(result.trial, SharedTrial):
+            result.trial = OpenSharedTrial(result.trial)
+        return result
+    except Exception as err:
+        return BatchResult(path, error=str(err), errortype=type(err).__name__)
+
+def _ReadFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _WarmFile(path, blocksize=1 << 20):
+    # Reads a file through a small reused buffer, bringing it into the operating system cache without holding it
+    block = bytearray(blocksize)
+    with open(path, 'rb', buffering=0) as f:
+        while f.readinto(block):
+            pass
+    return None
+
+def ExtractPipeline(source, workers=None, readers=4, maxbytes=512*1024**2, ordered=True, recursive=True,
+    backend='ezc3d', extract=ExtractTrialData, shared=False, **kwargs):
+    """
+    Extracts every c3d file in source, reading files ahead of the extraction workers so slow storage and decoding overlap.
+
+    Reader threads read files ahead, at most readers at a time, bringing them into the operating system cache
+    so the worker processes map or open them without waiting on the storage. Nothing is sent to the workers but
+    the path. With a single in-process worker and the 'mmap' backend the file is read into memory instead and
+    decoded from those bytes. Throughput approaches the slower of reading and extracting rather than their sum.
+
+    Each file counts twice against maxbytes, once for the data read (the cached pages or the bytes) until it is
+    extracted and once for the decoded trial (estimated as the file size) until the result is yielded, so
+    results held back to keep the input order also hold back reading. A single larger file is still read once
+    nothing else is held.
+
+    :param source(string or list): Directory, glob pattern, file path or list of file paths
+    :param workers(int)(optional): Number of worker processes, defaults to the cpu count. 0 or 1 extracts in a thread of this process
+    :param readers(int)(optional): Number of files read concurrently
+    :param maxbytes(int)(optional): Memory budget for files read ahead and trials not yet yielded
+    :param ordered(bool)(optional): Yield results in input order, otherwise as they complete
+    :param recursive(bool)(optional): Search sub-directories when a directory is given
+    :param backend(string)(optional): 'ezc3d' or 'mmap', see c3dtrial.LoadC3D
+    :param extract(callable)(optional): Function used to extract each file, called as extract(path, backend=backend, **kwargs)
+        (and buffer=data with a single worker and the 'mmap' backend), must be picklable
+    :param shared(bool)(optional): Send the trial arrays back from the workers through scratch files, see ShareTrial
+    :param kwargs: Passed on to extract for every file
+    :return: results(generator): BatchResult per file
+    """
+    paths = FindC3DFiles(source, recursive=recursive)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def sizeOf(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    shared = shared and workers > 1
+    if shared:
+        RemoveScratchFiles()
+    task = partial(ExtractFileSafe, extract=extract, shared=shared, owner=os.getpid(), backend=backend, **kwargs)
+    # Only a worker in this process can use the bytes without copying them through a pipe
+    read = _ReadFile if workers <= 1 and backend == 'mmap' else _WarmFile
+    pending = deque(enumerate(paths))
+    reads = {}
+    loaded = deque()
+    running = {}
+    finished = {}
+    sizes = {}
+    held = 0
+    nextIndex = 0
+
+    readpool = ThreadPoolExecutor(max_workers=readers)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else ThreadPoolExecutor(max_workers=1)
+
+    def recover(unsubmitted=()):
+        # A worker died, re-run every file in flight one at a time so only the file that kills the pool is failed
+        nonlocal pool, held
+        pool.shutdown(wait=True)
+        calls = [running.pop(future) for future in list(running) if _IsBroken(future)] + list(unsubmitted)
+        pool, futures = _RerunAlone(task, [call for *_, call in calls], workers)
+        for (index, path, size, call), future in zip(calls, futures):
+            held -= size
+            finished[index] = _FutureResult(path, future)
+
+    def release(index):
+        # The result is handed over, release the budget of its trial
+        nonlocal held
+        held -= sizes.pop(index)
+        return finished.pop(index)
+
+    try:
+        while pending or reads or loaded or running:
+            # Read ahead within the memory budget
+            while pending and len(reads) < readers:
+                index, path = pending[0]
+                size = sizeOf(path)
+                if held and held + 2*size > maxbytes:
+                    break
+                pending.popleft()
+                held += 2*size
+                sizes[index] = size
+                reads[readpool.submit(read, path)] = (index, path, size)
+
+            # Keep every worker busy with files already read
+            while loaded and len(running) < 2*max(workers, 1):
+                index, path, size, data = loaded.popleft()
+                call = ((path,), {} if data is None else {'buffer': data})
+                try:
+                    future = pool.submit(task, *call[0], **call[1])
+                except BrokenProcessPool:
+                    recover([(index, path, size, call)])
+                    continue
+                running[future] = (index, path, size, call)
+
+            if reads or running:
+                done, _ = wait(list(reads) + list(running), return_when=FIRST_COMPLETED)
+                if any(future in running and _IsBroken(future) for future in done):
+                    recover()
+                    done = [future for future in done if future in reads]
+                for future in done:
+                    if future in reads:
+                        index, path, size = reads.pop(future)
+                        try:
+                            data = future.result()
+                        except Exception as err:
+                            held -= size
+                            finished[index] = BatchResult(path, error=str(err), errortype=type(err).__name__)
+                            continue
+                        loaded.append((index, path, size, data))
+                    else:
+                        index, path, size, call = running.pop(future)
+                        held -= size
+                        finished[index] = _FutureResult(path, future)
+
+            if ordered:
+                while nextIndex in finished:
+                    yield release(nextIndex)
+                    nextIndex += 1
+            else:
+                for index in list(finished):
+                    yield release(index)
+    finally:
+        readpool.shutdown(wait=True, cancel_futures=True)
+        for future in running:
+            _DiscardFuture(future)
+        pool.shutdown(wait=True)
+    return
+
+def _FileSha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _AnonymiseFile(job):
+    # Worker task, RewriteSubjectName writes the output atomically (see c3dreader.AtomicWrite)
+    path, output, subjectname = job['input'], job['output'], job['subject']
+    entry = dict(job)
+    try:
+        info = os.stat(path)
+        RewriteSubjectName(path, output, subjectname)
+        entry['output_sha256'] = _FileSha256(output)
+        entry['input_sha256'] = _FileSha256(path)
+        entry['input_size'] = info.st_size
+        entry['input_mtime'] = info.st_mtime_ns
+        entry['status'] = 'done'
+    except Exception as err:
+        entry['status'] = 'failed'
+        entry['error'] = f'{type(err).__name__}: {err}'
+    entry['time'] = time.time()
+    return entry
+
+def ReadManifest(manifest):
+    """
+    Reads an anonymisation manifest.
+
+    :param manifest(string): Path to the manifest (JSON lines)
+    :return: entries(dict): Input path -> latest entry for that file
+    """
+    entries = {}
+    if not os.path.exists(manifest):
+        return entries
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                entries[entry['input']] = entry
+    return entries
+
+def _InputUnchanged(entry, path):
+    # Whether a manifest entry was recorded for the file as it is now
+    try:
+        info = os.stat(path)
+    except OSError:
+        return False
+    return entry.get('input_size') == info.st_size and entry.get('input_mtime') == info.st_mtime_ns
+
+def _ManifestDone(entry, job):
+    if entry is None or entry['status'] != 'done' or entry['output'] != job['output'] or not os.path.exists(job['output']):
+        return False
+    return _InputUnchanged(entry, job['input'])
+
+def AnonymiseBatch(jobs, outputdir, manifest, workers=None):
+    """
+    Anonymises many c3d files across a process pool (see c3dtrial.AnonymiseC3D).
+
+    Each output is written to a temporary file and renamed into place, so an interrupted run never leaves
+    a partial file. Every file is recorded in the manifest with the sha256 of its input and output, and
+    files already done (same output, input unchanged in size and modification time) are skipped on re-runs.
+    The manifest links the original files to their anonymised copies, keep it out of the released data.
+
+    :param jobs(dict): Input path -> (subjectname, condition, trialno) or a dict with those keys, condition and trialno may be None
+    :param outputdir(string): Directory the anonymised files are written to, named as Anonymise.createFilePath
+    :param manifest(string): Path to the manifest (JSON lines), appended to as files complete
+    :param workers(int)(optional): Number of worker processes, defaults to the cpu count. 0 or 1 runs in this process
+    :return: entries(list): Manifest entry per job, status 'done', 'failed' or 'skipped'
+    """
+    os.makedirs(outputdir, exist_ok=True)
+
+    tasks = []
+    outputs = {}
+    for path, spec in jobs.items():
+        if isinstance(spec, dict):
+            subjectname, condition, trialno = spec['subjectname'], spec.get('condition'), spec.get('trialno')
+        else:
+            subjectname, condition, trialno = spec
+        output = AnonymisedFilePath(subjectname, outputdir, condition, trialno)
+        if output in outputs:
+            raise Exception(f"{path} and {outputs[output]} would both be saved as {output}")
+        outputs[output] = path
+        tasks.append({'input': path, 'output': output, 'subject': subjectname, 'condition': condition, 'trialno': trialno})
+
+    previous = ReadManifest(manifest)
+    entries = []
+    todo = []
+    for job in tasks:
+        if _ManifestDone(previous.get(job['input']), job):
+            entries.append(dict(previous[job['input']], status='skipped'))
+        else:
+            todo.append(job)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1:
+        results = (_AnonymiseFile(job) for job in todo)
+    else:
+        results = (_FutureAnonymise(job, future) for job, future in _RunPool(_AnonymiseFile, todo, workers, ordered=False))
+
+    with open(manifest, 'a') as f:
+        for entry in results:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            entries.append(entry)
+    return entries
+
+def _FutureAnonymise(job, future):
+    try:
+        return future.result()
+    except Exception as err:
+        return dict(job, status='failed', error=f'{type(err).__name__}: {err}', time=time.time())
+
+def ExtractToStore(source, output, format='hdf5', manifest=None, workers=None, recursive=True, retryfailed=False,
+    prefetch=0, extract=ExtractTrialData, **kwargs):
+    """
+    Extracts every c3d file in source into an output store, recording each file in a job manifest so an
+    interrupted run resumes where it stopped.
+
+    Files recorded as done (or failed, unless retryfailed) for the same output and format, whose size and
+    modification time are unchanged, are skipped. A file recorded as done is only skipped while its trial
+    is still in the output. Trials are keyed by their path relative to source (see c3dstore.TrialKey).
+
+    :param source(string or list): Directory, glob pattern, file path or list of file paths
+    :param output(string): HDF5 store file ('hdf5') or directory of .npz files ('npz')
+    :param format(string)(optional): 'hdf5' (c3dstore.TrialStore) or 'npz' (c3dstore.WriteTrialNpz)
+    :param manifest(string)(optional): Job manifest (JSON lines), defaults to '{output}.manifest.jsonl'
+    :param workers(int)(optional): Number of worker processes, see ExtractBatchData
+    :param recursive(bool)(optional): Search sub-directories when a directory is given
+    :param retryfailed(bool)(optional): Extract files that failed in an earlier run again
+    :param prefetch(int)(optional): Read files ahead with this many reader threads, see ExtractPipeline. 0 disables
+    :param extract(callable)(optional): Function used to extract each file, ignored with prefetch
+    :param kwargs: Passed on to extract for every file, e.g. channels, backend, NoPointSamples
+    :return: entries(generator): Manifest entry per file, status 'done', 'failed' or 'skipped'
+    """
+    from c3dstore import TrialStore, TrialKey, WriteTrialNpz
+
+    if format not in ('hdf5', 'npz'):
+        raise Exception(f"Unknown output format ({format}), use 'hdf5' or 'npz'")
+    if manifest is None:
+        manifest = output.rstrip(os.sep) + '.manifest.jsonl'
+
+    root = source if isinstance(source, str) and os.path.isdir(source) else None
+    paths = FindC3DFiles(source, recursive=recursive)
+    previous = ReadManifest(manifest)
+    target = {'output': os.path.abspath(output), 'format': format}
+
+    stored = set()
+    if format == 'hdf5' and os.path.exists(output):
+        try:
+            with TrialStore(output, mode='r') as store:
+                stored = set(store.keys())
+        except Exception as err:
+            print(f'Could not read {output} ({err}), extracting every file again')
+
+    def inOutput(key):
+        if format == 'hdf5':
+            return key in stored
+        return os.path.exists(os.path.join(output, key + '.npz'))
+
+    todo = []
+    for path in paths:
+        entry = previous.get(os.path.abspath(path))
+        key = TrialKey(path, root=root)
+        if entry is not None and all(entry.get(name) == value for name, value in target.items()) and entry['key'] == key \
+            and _InputUnchanged(entry, path) and ((entry['status'] == 'done' and inOutput(key))
+            or (entry['status'] == 'failed' and not retryfailed)):
+            yield dict(entry, status='skipped')
+        else:
+            todo.append(path)
+    if not todo:
+        return
+
+    if prefetch:
+        results = ExtractPipeline(todo, workers=workers, readers=prefetch, ordered=False, **kwargs)
+    else:
+        results = ExtractBatchData(todo, workers=workers, ordered=False, extract=extract, **kwargs)
+
+    if format == 'hdf5':
+        store = TrialStore(output)
+    else:
+        os.makedirs(output, exist_ok=True)
+        store = None
+
+    try:
+        with open(manifest, 'a') as f:
+            for result in results:
+                key = TrialKey(result.path, root=root)
+                entry = dict(target, input=os.path.abspath(result.path), key=key)
+                try:
+                    info = os.stat(result.path)
+                    entry['input_size'], entry['input_mtime'] = info.st_size, info.st_mtime_ns
+                except OSError:
+                    pass
+
+                if result.ok:
+                    try:
+                        if store is not None:
+                            store.addTrial(result.trial, key, overwrite=True, source=result.path)
+                            store.h5.flush()
+                        else:
+                            WriteTrialNpz(result.trial, os.path.join(output, key + '.npz'), source=result.path)
+                        entry['status'] = 'done'
+                    except Exception as err:
+                        entry['status'], entry['error'] = 'failed', f'{type(err).__name__}: {err}'
+                else:
+                    entry['status'], entry['error'] = 'failed', f'{result.errortype}: {result.error}'
+
+                entry['time'] = time.time()
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                yield entry
+    finally:
+        results.close()
+        if store is not None:
+            store.close()
+    return
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Extract gait data from every c3d file in a directory or glob.')
+    parser.add_argument('source', help='Directory, glob pattern or c3d file')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes (default: cpu count)')
+    parser.add_argument('--unordered', action='store_true', help='Report files as they complete rather than in order')
+    parser.add_argument('--metadata', action='store_true', help='Only read events and channel labels, skipping the point and analog data')
+    parser.add_argument('--backend', choices=['ezc3d', 'mmap'], default='ezc3d', help='c3d reader backend (default: ezc3d)')
+    parser.add_argument('--channels', nargs='+', default=None, help="Channel groups or labels to keep, e.g. 'kinematics' 'emg' or 'LRF'")
+    parser.add_argument('-o', '--output', default=None, help='Save the trials to this HDF5 store (or npz directory), resuming from its manifest if it exists')
+    parser.add_argument('--format', choices=['hdf5', 'npz'], default='hdf5', help='Output format with --output (default: hdf5)')
+    parser.add_argument('--float32', action='store_true', help='Keep the channel data and every derived dataset in float32, halving memory and store size')
+    parser.add_argument('--samples', type=int, default=51, help='Samples the gait cycle kinematics are normalised to (default: 51)')
+    parser.add_argument('--manifest', default=None, help='Job manifest with --output (default: OUTPUT.manifest.jsonl)')
+    parser.add_argument('--retry-failed', action='store_true', help='With --output, extract files that failed in an earlier run again')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='READERS', help='Read files ahead of extraction with this many reader threads (for slow or network storage)')
+    parser.add_argument('--shared-memory', action='store_true', help='Return the trial arrays from the workers through shared memory scratch files rather than pickling them')
+    parser.add_argument('--cache', default=None, help='Directory of an extraction cache, unchanged files are loaded from it rather than re-extracted')
+    args = parser.parse_args(argv)
+
+    if args.metadata:
+        extract, kwargs = ScanTrialMetadata, {}
+    else:
+        extract, kwargs = ExtractTrialData, {'channels': args.channels, 'backend': args.backend, 'NoPointSamples': args.samples}
+        if args.float32:
+            kwargs['dtype'] = 'float32'
+        if args.cache:
+            from c3dcache import ExtractionCache
+            cache = ExtractionCache(args.cache)
+            extract = cache.extract
+
+    if args.output:
+        if args.metadata:
+            parser.error('--output stores extracted trials and cannot be used with --metadata')
+        counts = {'done': 0, 'failed': 0, 'skipped': 0}
+        for entry in ExtractToStore(args.source, args.output, format=args.format, manifest=args.manifest, workers=args.workers,
+            retryfailed=args.retry_failed, prefetch=0 if args.cache else args.prefetch, extract=extract, shared=args.shared_memory, **kwargs):
+            counts[entry['status']] += 1
+            if entry['status'] == 'failed':
+                print(f"FAILED {entry['input']} ({entry['error']})")
+            elif entry['status'] == 'done':
+                print(f"OK     {entry['input']}")
+        print(f"{counts['done']} extracted, {counts['failed']} failed, {counts['skipped']} already in the manifest")
+        return 1 if counts['failed'] and not (counts['done'] or counts['skipped']) else 0
+
+    nok, nfail = 0, 0
+    if args.prefetch and not args.metadata and not args.cache:
+        kwargs.pop('backend')
+        results = ExtractPipeline(args.source, workers=args.workers, readers=args.prefetch, ordered=not args.unordered,
+            backend=args.backend, shared=args.shared_memory, **kwargs)
+    else:
+        results = ExtractBatchData(args.source, workers=args.workers, ordered=not args.unordered, extract=extract,
+            shared=args.shared_memory, **kwargs)
+
+    for result in results:
+        if result.ok:
+            nok += 1
+            print(f'OK     {result.path}')
+        else:
+            nfail += 1
+            print(f'FAILED {result.path} ({result.errortype}: {result.error})')
+
+    print(f'{nok} extracted, {nfail} failed')
+    if not args.metadata and args.cache:
+        stats = cache.stats()
+        print(f"cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} trials, {stats['bytes']/1024**2:.1f} MB")
+    return 1 if nfail and not nok else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+
+import c3dtrial
+from c3dtrial import ExtractTrialData
+from c3dreader import AtomicWrite
+
+HASH_BLOCK = 1 << 20
+
+# Part of every key, version 2 caches trials with their cycle datasets computed, version 3 with CycleData
+# normalised as the trial requests
+CACHE_VERSION = 3
+
+def FileHash(path):
+    """
+    Returns the blake2b hash of a file's contents.
+
+    :param path(string): Path to the file
+    :return: digest(string): Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ExtractionCache:
+    """
+    Persistent cache of extracted GaitTrial objects, keyed by the c3d file contents and the extraction options.
+
+    Trials are pickled to cachedir/objects and indexed in a SQLite database (cachedir/index.sqlite)
+    that also records access times for least recently used eviction and the hit/miss counts. A hit
+    never opens the c3d file with ezc3d. File hashes are remembered by path, size and modification
+    time so unchanged files are not re-read to compute their key. Safe to share between processes,
+    e.g. as the extract function of c3dbatch.ExtractBatchData.
+    """
+
+    def __init__(self, cachedir, maxbytes=10*1024**3):
+        """
+        :param cachedir(string): Directory holding the cache, created if missing
+        :param maxbytes(int)(optional): Maximum total size of the cached trials, least recently used trials are evicted beyond it
+        :return: None
+        """
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        os.makedirs(os.path.join(cachedir, 'objects'), exist_ok=True)
+
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, source TEXT, bytes INTEGER, created REAL, accessed REAL, hits INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            db.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+        return
+
+    @contextmanager
+    def _connect(self):
+        # Commits on success, rolls back on error, and always closes the connection
+        db = sqlite3.connect(os.path.join(self.cachedir, 'index.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _objectPath(self, key):
+        return os.path.join(self.cachedir, 'objects', key[:2], key + '.pkl')
+
+    def fileHash(self, path):
+        """
+        Returns the content hash of a file, reusing the stored hash if its size and modification time are unchanged.
+
+        :param path(string): Path to the c3d file
+        :return: digest(string): Hex digest of the file contents
+        """
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        with self._connect() as db:
+            row = db.execute('SELECT size, mtime, hash FROM files WHERE path=?', (path,)).fetchone()
+        if row is not None and row[0] == info.st_size and row[1] == info.st_mtime_ns:
+            return row[2]
+
+        digest = FileHash(path)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, info.st_size, info.st_mtime_ns, digest))
+        return digest
+
+    def key(self, path, **kwargs):
+        """
+        Returns the cache key of a file for a set of ExtractTrialData options.
+
+        :param path(string): Path to the c3d file
+        :param kwargs: ExtractTrialData options, lazy is ignored as trials are cached with their cycle datasets computed
+        :return: key(string): Hex digest of the file hash, options and library version
+        """
+        options = dict(kwargs)
+        options.pop('lazy', None)
+        channels = options.get('channels')
+        if channels is not None:
+            options['channels'] = sorted([channels] if isinstance(channels, str) else channels)
+
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.fileHash(path).encode())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        digest.update(f'{c3dtrial.__version__}/{CACHE_VERSION}'.encode())
+        return digest.hexdigest()
+
+    def _count(self, db, name, value=1):
+        db.execute('UPDATE stats SET value = value + ? WHERE name=?', (value, name))
+        return
+
+    def get(self, key):
+        """
+        Returns the cached trial for a key, or None if it is not cached.
+
+        :param key(string): Cache key, see key()
+        :return: trial(GaitTrial or None)
+        """
+        try:
+            with open(self._objectPath(key), 'rb') as f:
+                trial = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        with self._connect() as db:
+            db.execute('UPDATE entries SET accessed=?, hits=hits+1 WHERE key=?', (time.time(), key))
+            self._count(db, 'hits')
+        return trial
+
+    def put(self, key, trial, source=None):
+        """
+        Stores a trial under a key, then evicts the least recently used trials beyond maxbytes.
+
+        :param key(string): Cache key, see key()
+        :param trial(GaitTrial): Extracted trial
+        :param source(string)(optional): Path of the c3d file, kept for inspection
+        :return: None
+        """
+        path = self._objectPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Readers never see a partial pickle
+        with AtomicWrite(path) as f:
+            pickle.dump(trial, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, 0)', (key, source, os.path.getsize(path), now, now))
+        self.evict()
+        return
+
+    def extract(self, path, **kwargs):
+        """
+        Returns the trial for a file from the cache, extracting and caching it on a miss.
+
+        Trials are extracted with lazy=False before being cached, so a hit does not redo the cycle
+        slicing and normalisation.
+
+        :param path(string): Path to the c3d file
+        :param kwargs: ExtractTrialData options, part of the cache key
+        :return: trial(GaitTrial)
+        """
+        key = self.key(path, **kwargs)
+        trial = self.get(key)
+        if trial is not None:
+            return trial
+
+        with self._connect() as db:
+            self._count(db, 'misses')
+        trial = ExtractTrialData(path, **dict(kwargs, lazy=False))
+        self.put(key, trial, source=os.path.abspath(path))
+        return trial
+
+    def evict(self, maxbytes=None):
+        """
+        Removes the least recently used trials until the cache is within maxbytes.
+
+        :param maxbytes(int)(optional): Size limit, defaults to the cache's maxbytes
+        :return: removed(int): Number of trials removed
+        """
+        maxbytes = self.maxbytes if maxbytes is None else maxbytes
+        removed = 0
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+            if total <= maxbytes:
+                return 0
+            for key, size in db.execute('SELECT key, bytes FROM entries ORDER BY accessed').fetchall():
+                if total <= maxbytes:
+                    break
+                try:
+                    os.remove(self._objectPath(key))
+                except FileNotFoundError:
+                    pass
+                db.execute('DELETE FROM entries WHERE key=?', (key,))
+                total -= size
+                removed += 1
+            self._count(db, 'evictions', removed)
+        return removed
+
+    def clear(self):
+        """Removes every cached trial and resets the statistics."""
+        self.evict(maxbytes=-1)
+        with self._connect() as db:
+            db.execute('UPDATE stats SET value = 0')
+        return
+
+    def stats(self):
+        """
+        Returns the cache statistics.
+
+        :return: stats(dict): hits, misses, evictions, hit_rate, entries, bytes and maxbytes
+        """
+        with self._connect() as db:
+            stats = dict(db.execute('SELECT name, value FROM stats').fetchall())
+            stats['entries'], stats['bytes'] = db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits']/lookups if lookups else 0.0
+        stats['maxbytes'] = self.maxbytes
+        return stats
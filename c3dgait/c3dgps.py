@@ -0,0 +1,260 @@
+import json
+import struct
+
+import numpy as np
+
+from c3dtrial import AsChannelData, NormaliseCycles, ExtractTrialData
+from c3dreader import AtomicWrite
+
+NORMATIVE_MAGIC = b'C3DNORM1'
+NORMATIVE_ALIGN = 64
+
+# Kinematic variables of the Gait Profile Score (Baker et al. 2009), per side as in GaitTrial.gpskinematics
+GPS_VARIABLES = ('Pelvic Tilt', 'Pelvic Obliquity', 'Pelvic Rotation', 'Hip Flexion', 'Hip Abduction',
+    'Hip Rotation', 'Knee Flexion', 'Ankle Dorsiflexion', 'Foot Progression')
+
+# The pelvis is counted once (left side) in the overall score
+PELVIS_VARIABLES = ('Pelvic Tilt', 'Pelvic Obliquity', 'Pelvic Rotation')
+
+GPS_LABELS = tuple(f'{variable} {side}' for side in ('Left', 'Right') for variable in GPS_VARIABLES)
+
+def GaitDataArray(trials, labels=GPS_LABELS, samples=None):
+    """
+    Stacks the gait profile kinematics of many trials into one array.
+
+    Trials normalised to another number of samples are resampled with linear interpolation.
+
+    :param trials(list or GaitTrial): GaitTrial objects, or gpskinematics as ChannelData or label -> curve dicts
+    :param labels(list)(optional): Variables to stack, in order
+    :param samples(int)(optional): Number of samples per curve, by default the largest of the trials
+    :return: data(numpy.array): (trials x variables x samples), NaN for variables a trial does not have
+    """
+    if not isinstance(trials, (list, tuple)):
+        trials = [trials]
+    channels = [AsChannelData(getattr(trial, 'gpskinematics', trial)) for trial in trials]
+    if samples is None:
+        samples = max((channel.data.shape[-1] for channel in channels if len(channel)), default=0)
+
+    data = np.full((len(channels), len(labels), samples), np.nan)
+    for i, channel in enumerate(channels):
+        rows = [j for j, label in enumerate(labels) if label in channel]
+        if not rows:
+            continue
+        curves = np.stack([channel[labels[j]] for j in rows])
+        if curves.shape[-1] != samples:
+            curves = NormaliseCycles(curves, samples, 'linear')
+        data[i, rows] = curves
+    return data
+
+class GaitProfileScore:
+    """
+    Computes Gait Variable Scores (GVS) and Gait Profile Scores (GPS) against normative mean curves.
+
+    GVS is the RMS difference between a trial's normalised curve and the normative mean, GPS the RMS
+    of the GVS of the nine variables of a side. The overall GPS uses both sides with the pelvis
+    counted once. Any number of trials is scored in one broadcast computation.
+    """
+
+    def __init__(self, labels, mean):
+        """
+        :param labels(list): Variable labels, e.g. GPS_LABELS
+        :param mean(numpy.array): (variables x samples) normative mean curves in the order of labels
+        :return: None
+        """
+        self.labels = list(labels)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        if self.mean.shape[0] != len(self.labels):
+            raise Exception(f"{len(self.labels)} labels given for {self.mean.shape[0]} normative curves")
+
+        index = {label: i for i, label in enumerate(self.labels)}
+        self.sides = {side: np.array([index.get(f'{variable} {side}', -1) for variable in GPS_VARIABLES])
+            for side in ('Left', 'Right')}
+        overall = [f'{variable} Left' for variable in GPS_VARIABLES]
+        overall += [f'{variable} Right' for variable in GPS_VARIABLES if variable not in PELVIS_VARIABLES]
+        self.overall = np.array([index.get(label, -1) for label in overall])
+        return
+
+    @classmethod
+    def fromDict(cls, reference):
+        """
+        :param reference(dict): Variable label -> normative mean curve
+        :return: engine(GaitProfileScore)
+        """
+        reference = AsChannelData(reference)
+        return cls(reference.labels, reference.data)
+
+    def _meanCurves(self, samples):
+        if self.mean.shape[-1] == samples:
+            return self.mean
+        return NormaliseCycles(self.mean, samples, 'linear')
+
+    def score(self, data):
+        """
+        Scores normalised gait data.
+
+        :param data(numpy.array): (..., variables x samples) curves in the order of labels, e.g. from GaitDataArray
+        :return: scores(dict): 'labels', 'GVS' (... x variables) and 'GPS', 'GPS Left', 'GPS Right' (...) arrays,
+            a GPS is NaN when one of its variables is missing
+        """
+        data = np.asarray(data, dtype=np.float64)
+        gvs = np.sqrt(np.mean((data - self._meanCurves(data.shape[-1]))**2, axis=-1))
+
+        # Index -1 selects a NaN column for variables without a normative curve
+        padded = np.concatenate([gvs, np.full(gvs.shape[:-1] + (1,), np.nan)], axis=-1)
+
+        def rms(indices):
+            return np.sqrt(np.mean(padded[..., indices]**2, axis=-1))
+
+        return {
+            'labels': self.labels,
+            'GVS': gvs,
+            'GPS Left': rms(self.sides['Left']),
+            'GPS Right': rms(self.sides['Right']),
+            'GPS': rms(self.overall),
+        }
+
+    def scoreTrials(self, trials):
+        """
+        Scores GaitTrial objects (or their gpskinematics).
+
+        :param trials(list or GaitTrial): Trials to score
+        :return: scores(dict): See score, with a leading trials axis
+        """
+        return self.score(GaitDataArray(trials, self.labels))
+
+class NormativeReference:
+    """
+    Normative gait reference built from control trials: per variable mean and SD curves, the covariance
+    between the samples of each variable and the number of controls.
+
+    Saved as one binary file, a JSON header followed by the aligned float64 arrays, which load() memory
+    maps so opening a reference costs nothing until the curves are read.
+    """
+
+    ARRAYS = ('mean', 'sd', 'cov', 'count')
+
+    def __init__(self, labels, mean, sd, cov, count):
+        """
+        :param labels(list): Variable labels
+        :param mean(numpy.array): (variables x samples) mean curves
+        :param sd(numpy.array): (variables x samples) standard deviation curves
+        :param cov(numpy.array): (variables x samples x samples) covariance of each variable's curve
+        :param count(numpy.array): (variables) number of controls with each variable
+        :return: None
+        """
+        self.labels = list(labels)
+        self.mean = mean
+        self.sd = sd
+        self.cov = cov
+        self.count = count
+        self.samples = mean.shape[-1]
+        self._engine = None
+        self._precision = None
+        return
+
+    @classmethod
+    def fromData(cls, data, labels=GPS_LABELS):
+        """
+        :param data(numpy.array): (trials x variables x samples) control curves, NaN where a trial lacks a variable
+        :param labels(list)(optional): Variable labels in the order of data
+        :return: reference(NormativeReference)
+        """
+        data = np.asarray(data, dtype=np.float64)
+        valid = ~np.isnan(data).any(axis=-1)
+        count = valid.sum(axis=0)
+        if (count < 2).any():
+            missing = [label for label, n in zip(labels, count) if n < 2]
+            raise Exception(f"Fewer than 2 control trials with {', '.join(missing)}")
+
+        mean = np.nanmean(data, axis=0)
+        centred = np.where(valid[..., None], data - mean, 0.0)
+        cov = np.einsum('tvi,tvj->vij', centred, centred)/(count - 1)[:, None, None]
+        sd = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        return cls(labels, mean, sd, cov, count.astype(np.float64))
+
+    @classmethod
+    def fromTrials(cls, trials, labels=GPS_LABELS, **kwargs):
+        """
+        Builds a reference from control trials.
+
+        :param trials(list): GaitTrial objects or c3d paths (extracted with ExtractTrialData(path, **kwargs))
+        :param labels(list)(optional): Variables to include
+        :return: reference(NormativeReference)
+        """
+        trials = [ExtractTrialData(trial, channels='kinematics', **kwargs) if isinstance(trial, str) else trial for trial in trials]
+        return cls.fromData(GaitDataArray(trials, labels), labels)
+
+    def save(self, path):
+        """
+        Writes the reference to a binary file, replacing path only once it is complete.
+
+        :param path(string): Output path
+        :return: None
+        """
+        arrays = {name: np.ascontiguousarray(getattr(self, name), dtype='<f8') for name in self.ARRAYS}
+        header = {'labels': self.labels, 'samples': self.samples, 'arrays': {}}
+
+        # Offsets depend on the header length, so size the header with placeholder offsets first
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = {'shape': list(array.shape), 'offset': 0}
+        for _ in range(2):
+            start = len(NORMATIVE_MAGIC) + 4 + len(json.dumps(header).encode())
+            offset = -(-start//NORMATIVE_ALIGN)*NORMATIVE_ALIGN
+            for name, array in arrays.items():
+                header['arrays'][name]['offset'] = offset
+                offset = -(-(offset + array.nbytes)//NORMATIVE_ALIGN)*NORMATIVE_ALIGN
+        encoded = json.dumps(header).encode()
+
+        with AtomicWrite(path) as f:
+            f.write(NORMATIVE_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+            for name, array in arrays.items():
+                f.write(bytes(header['arrays'][name]['offset'] - f.tell()))
+                f.write(array.tobytes())
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps a reference written by save.
+
+        :param path(string): Path to the reference file
+        :return: reference(NormativeReference)
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(NORMATIVE_MAGIC)) != NORMATIVE_MAGIC:
+                raise Exception(f"{path} is not a normative reference file")
+            length = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(length))
+
+        arrays = {name: np.memmap(path, dtype='<f8', mode='r', offset=spec['offset'], shape=tuple(spec['shape']))
+            for name, spec in header['arrays'].items()}
+        return cls(header['labels'], arrays['mean'], arrays['sd'], arrays['cov'], arrays['count'])
+
+    @property
+    def engine(self):
+        """GaitProfileScore against the reference mean curves."""
+        if self._engine is None:
+            self._engine = GaitProfileScore(self.labels, self.mean)
+        return self._engine
+
+    def score(self, trials):
+        """
+        Scores trials against the reference.
+
+        :param trials(list or GaitTrial or numpy.array): Trials, or (trials x variables x samples) curves in the order of labels
+        :return: scores(dict): GaitProfileScore.score results plus 'Z' (trials x variables x samples) z-score curves
+            and 'Mahalanobis' (trials x variables) distance of each curve from the reference
+        """
+        data = trials if isinstance(trials, np.ndarray) else GaitDataArray(trials, self.labels)
+        if data.shape[-1] != self.samples:
+            data = NormaliseCycles(data, self.samples, 'linear')
+
+        scores = self.engine.score(data)
+        deviation = data - self.mean
+        scores['Z'] = deviation/self.sd
+
+        if self._precision is None:
+            self._precision = np.linalg.pinv(self.cov, hermitian=True)
+        scores['Mahalanobis'] = np.sqrt(np.einsum('...vi,vij,...vj->...v', deviation, self._precision, deviation))
+        return scores
@@ -0,0 +1,364 @@
+import os
+import time
+import sqlite3
+import hashlib
+
+from c3dreader import readHeader, ReadC3DMetadata, BLOCK_SIZE
+from c3dtrial import EventData, ChannelSchema, GetChannelSchema, EMG_LABEL_CONVERSION
+from c3dbatch import FindC3DFiles, ExtractBatchData
+
+# Version 2 indexes trials without the full gait cycle, version 3 trials with an unknown or no EMG system,
+# older indexes re-read every file on the next update
+INDEX_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER, mtime INTEGER,
+    hash TEXT, indexed REAL, error TEXT);
+CREATE TABLE IF NOT EXISTS trials (
+    file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE, subject TEXT,
+    points_rate REAL, analogs_rate REAL, emgset TEXT, events INTEGER,
+    left_cycles INTEGER, right_cycles INTEGER, full_cycle INTEGER);
+CREATE TABLE IF NOT EXISTS channels (
+    file_id INTEGER REFERENCES files(id) ON DELETE CASCADE, kind TEXT, label TEXT, original TEXT);
+CREATE TABLE IF NOT EXISTS events (
+    file_id INTEGER REFERENCES files(id) ON DELETE CASCADE, time REAL, context TEXT, label TEXT,
+    point_frame INTEGER, analog_frame INTEGER);
+CREATE TABLE IF NOT EXISTS cycles (
+    file_id INTEGER REFERENCES files(id) ON DELETE CASCADE, side TEXT, number INTEGER,
+    start_time REAL, end_time REAL, start_point INTEGER, end_point INTEGER, start_analog INTEGER, end_analog INTEGER);
+CREATE INDEX IF NOT EXISTS trials_emgset ON trials(emgset);
+CREATE INDEX IF NOT EXISTS trials_subject ON trials(subject);
+CREATE INDEX IF NOT EXISTS channels_label ON channels(label, file_id);
+CREATE INDEX IF NOT EXISTS channels_file ON channels(file_id);
+CREATE INDEX IF NOT EXISTS events_file ON events(file_id);
+CREATE INDEX IF NOT EXISTS cycles_file ON cycles(file_id, side);
+'''
+
+def MetadataHash(path):
+    """
+    Returns the hash of the header and parameter sections of a c3d file, i.e. everything the index is built from.
+
+    :param path(string): Path to the c3d file
+    :return: digest(string): Hex digest
+    """
+    with open(path, 'rb') as f:
+        header = readHeader(f)
+        f.seek(0)
+        blob = f.read(max(header['data_block'] - 1, header['parameter_block'])*BLOCK_SIZE)
+    return hashlib.blake2b(blob, digest_size=20).hexdigest()
+
+# Event order from the first foot strike that makes up the full gait cycle, as EventData.getGaitcycles checks it
+FULL_CYCLE_EVENTS = ['Foot Strike', 'Foot Off', 'Foot Strike', 'Foot Off', 'Foot Strike', 'Foot Off', 'Foot Strike']
+
+class IndexEvents(EventData):
+    """
+    Events of a trial sorted and framed as EventData does, without requiring the full gait cycle.
+
+    EventData rejects trials that are not evented or lack the 7 event full cycle, the index keeps
+    their events and cycles and records whether the full cycle is present.
+    """
+
+    def __init__(self, metadata):
+        """
+        :param metadata(dict): Metadata from c3dreader.ReadC3DMetadata
+        :return: None
+        """
+        header = metadata['header']
+        self.PointsFirstFrame = header['points']['first_frame']
+        self.PointsFrequency = header['points']['frame_rate']
+        self.AnalogsFirstFrame = header['analogs']['first_frame']
+        self.AnalogsFrequency = header['analogs']['frame_rate']
+
+        event = metadata['parameters'].get('EVENT', {})
+        if 'TIMES' in event:
+            self.organiseEventData(event['TIMES']['value'][1], event['LABELS']['value'], event['CONTEXTS']['value'])
+        else:
+            self.eventdata = []
+        return
+
+    def cycles(self, side):
+        """
+        :param side(string): 'Left' or 'Right'
+        :return: cycles(list): Every consecutive pair of foot strikes of the side, as GaitTrial.ExtractAllCycles uses
+        """
+        strikes = [event for event in self.eventdata if (event[1] == side) and (event[2] == "Foot Strike")]
+        return list(zip(strikes[:-1], strikes[1:]))
+
+    def fullCycle(self):
+        """
+        :return: cycle(list): First and last event of the full gait cycle, None if the events do not make one
+        """
+        strikes = [i for i, event in enumerate(self.eventdata) if event[2] == "Foot Strike"]
+        if not strikes:
+            return None
+        events = self.eventdata[strikes[0]:strikes[0] + len(FULL_CYCLE_EVENTS)]
+        if [event[2] for event in events] != FULL_CYCLE_EVENTS:
+            return None
+        return [events[0], events[-1]]
+
+class IndexSchema(ChannelSchema):
+    """
+    Channel classification of a layout whose EMG labels cannot be converted.
+
+    ChannelSchema fails when the EMG system is not in EMG_LABEL_CONVERSION or the trial has no voltage
+    channels, the index keeps the EMG labels as recorded and the emgset as 'unknown', or None without EMG.
+    """
+
+    def ConvertEMGLabel(self):
+        if getattr(self, 'emgset', None) in EMG_LABEL_CONVERSION:
+            return ChannelSchema.ConvertEMGLabel(self)
+        self.newEMGLabels = list(self.EmgLabels)
+        return
+
+def ScanIndexEntry(path):
+    """
+    Reads the index rows of one c3d file from its metadata, without decoding the point and analog data.
+
+    Trials without the full gait cycle are indexed with the events and cycles they have, trials with an
+    unknown or no EMG system with their EMG labels unconverted (see IndexSchema).
+
+    :param path(string): Path to the c3d file
+    :return: entry(dict): 'hash', 'error' (None if the metadata was read) and the 'trial', 'channels', 'events' and 'cycles' rows
+    """
+    entry = {'hash': MetadataHash(path), 'error': None}
+    try:
+        metadata = ReadC3DMetadata(path)
+        parameters = metadata['parameters']
+        events = IndexEvents(metadata)
+        Groups = {group: parameters['POINT'][key]['value'] for group, key in
+            (('Angles', 'ANGLES'), ('Powers', 'POWERS'), ('Moments', 'MOMENTS'), ('Forces', 'FORCES'))}
+        layout = (parameters['POINT']['LABELS']['value'], Groups, parameters['ANALOG']['LABELS']['value'],
+            parameters['ANALOG']['DESCRIPTIONS']['value'], parameters['ANALOG']['UNITS']['value'])
+        try:
+            schema = GetChannelSchema(*layout)
+        except (KeyError, AttributeError):
+            schema = IndexSchema(*layout)
+    except Exception as err:
+        entry['error'] = f'{type(err).__name__}: {err}'
+        return entry
+
+    try:
+        subject = parameters['SUBJECTS']['NAMES']['value'][0]
+    except (KeyError, IndexError):
+        subject = None
+
+    cycles = [(side, number, start[0], end[0], start[3], end[3], start[4], end[4])
+        for side in ('Left', 'Right') for number, (start, end) in enumerate(events.cycles(side))]
+    full = events.fullCycle()
+    if full is not None:
+        start, end = full
+        cycles.append(('Full', 0, start[0], end[0], start[3], end[3], start[4], end[4]))
+
+    channels = [('kinematics', label, label) for label in schema.KinematicChannels]
+    channels += [('powers', label, label) for label in schema.PowerChannels]
+    channels += [('moments', label, label) for label in schema.MomentChannels]
+    channels += [('forces', label, label) for label in schema.ForceChannels]
+    channels += [('emg', label, original) for original, label in zip(schema.EmgLabels, schema.newEMGLabels)]
+    channels += [('forceplate', label, label) for label in schema.ForceplateLabels]
+    channels += [('otheranalogs', label, label) for label in schema.OtherAnalogLabels]
+
+    entry['trial'] = (subject, float(events.PointsFrequency), float(events.AnalogsFrequency),
+        getattr(schema, 'emgset', None), len(events.eventdata), sum(1 for c in cycles if c[0] == 'Left'),
+        sum(1 for c in cycles if c[0] == 'Right'), int(full is not None))
+    entry['channels'] = channels
+    entry['events'] = [(float(e[0]), e[1], e[2], int(e[3]), int(e[4])) for e in events.eventdata]
+    entry['cycles'] = [(side, number, float(t0), float(t1), int(p0), int(p1), int(a0), int(a1))
+        for side, number, t0, t1, p0, p1, a0, a1 in cycles]
+    return entry
+
+class TrialIndex:
+    """
+    SQLite index of the subjects, rates, EMG system, channels, events and cycles of every trial in an archive.
+
+    Built from the c3d metadata only (see ScanIndexEntry) and updated incrementally: files with an
+    unchanged size and modification time are skipped, and files whose header and parameter sections hash
+    the same as when indexed keep their rows. Query with findTrials, or with SQL on the 'files', 'trials',
+    'channels', 'events' and 'cycles' tables, and pass the paths to c3dbatch.ExtractBatchData.
+    """
+
+    def __init__(self, path):
+        """
+        :param path(string): Path to the index database, created if missing
+        :return: None
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        self.db.executescript(SCHEMA)
+        if version < INDEX_VERSION:
+            self.db.execute('UPDATE files SET size=NULL, mtime=NULL, hash=NULL')
+        self.db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+        self.db.commit()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.db.close()
+        return
+
+    def _write(self, fileId, entry):
+        db = self.db
+        for table in ('trials', 'channels', 'events', 'cycles'):
+            db.execute(f'DELETE FROM {table} WHERE file_id=?', (fileId,))
+        if entry.get('error') is not None:
+            return
+        db.execute('INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (fileId,) + entry['trial'])
+        db.executemany('INSERT INTO channels VALUES (?, ?, ?, ?)', [(fileId,) + row for row in entry['channels']])
+        db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)', [(fileId,) + row for row in entry['events']])
+        db.executemany('INSERT INTO cycles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(fileId,) + row for row in entry['cycles']])
+        return
+
+    def update(self, source, recursive=True, workers=None, prune=True, commitevery=500):
+        """
+        Indexes new and changed c3d files.
+
+        :param source(string or list): Directory, glob pattern, file path or list of file paths
+        :param recursive(bool)(optional): Search sub-directories when a directory is given
+        :param workers(int)(optional): Number of worker processes reading metadata, see ExtractBatchData
+        :param prune(bool)(optional): Remove indexed files under a source directory that no longer exist
+        :param commitevery(int)(optional): Files written between commits, an interrupted update keeps what was committed
+        :return: counts(dict): Number of files 'indexed', 'unchanged', 'touched' (new mtime, same metadata), 'failed' and 'removed'
+        """
+        counts = {'indexed': 0, 'unchanged': 0, 'touched': 0, 'failed': 0, 'removed': 0}
+        known = {path: (fileId, size, mtime, digest) for fileId, path, size, mtime, digest
+            in self.db.execute('SELECT id, path, size, mtime, hash FROM files')}
+
+        paths = [os.path.abspath(path) for path in FindC3DFiles(source, recursive=recursive)]
+        stats = {}
+        todo = []
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (info.st_size, info.st_mtime_ns)
+            row = known.get(path)
+            if row is not None and (row[1], row[2]) == stats[path]:
+                counts['unchanged'] += 1
+            else:
+                todo.append(path)
+
+        written = 0
+        for result in ExtractBatchData(todo, workers=workers, ordered=False, extract=ScanIndexEntry):
+            size, mtime = stats[result.path]
+            entry = result.trial if result.ok else {'hash': None, 'error': f'{result.errortype}: {result.error}'}
+            row = known.get(result.path)
+
+            if row is not None and entry['hash'] is not None and row[3] == entry['hash']:
+                self.db.execute('UPDATE files SET size=?, mtime=? WHERE id=?', (size, mtime, row[0]))
+                counts['touched'] += 1
+                continue
+
+            if row is None:
+                fileId = self.db.execute('INSERT INTO files (path) VALUES (?)', (result.path,)).lastrowid
+            else:
+                fileId = row[0]
+            self.db.execute('UPDATE files SET size=?, mtime=?, hash=?, indexed=?, error=? WHERE id=?',
+                (size, mtime, entry['hash'], time.time(), entry['error'], fileId))
+            self._write(fileId, entry)
+            counts['failed' if entry['error'] else 'indexed'] += 1
+
+            written += 1
+            if written % commitevery == 0:
+                self.db.commit()
+
+        if prune and isinstance(source, str) and os.path.isdir(source):
+            root = os.path.join(os.path.abspath(source), '')
+            found = set(paths)
+            removed = [(row[0],) for path, row in known.items() if path.startswith(root) and path not in found]
+            self.db.executemany('DELETE FROM files WHERE id=?', removed)
+            counts['removed'] = len(removed)
+
+        self.db.commit()
+        return counts
+
+    def query(self, sql, params=()):
+        """
+        Runs a SQL query on the index.
+
+        :param sql(string): Query, e.g. "SELECT path FROM files JOIN trials ON trials.file_id = files.id WHERE emgset = ?"
+        :param params(tuple)(optional): Query parameters
+        :return: rows(list): Result rows as tuples
+        """
+        return self.db.execute(sql, params).fetchall()
+
+    def findTrials(self, emgset=None, subject=None, minLeftCycles=0, minRightCycles=0, fullCycle=None, channels=None,
+        pathLike=None, pointsRate=None, analogsRate=None):
+        """
+        Returns the paths of indexed trials matching every given criterion.
+
+        :param emgset(string)(optional): EMG system, 'delsys', 'sys1', 'sys2', 'sys3' or 'unknown' (trials without
+            EMG channels have none and match only when emgset is not given)
+        :param subject(string)(optional): Subject name
+        :param minLeftCycles(int)(optional): Minimum number of left cycles (consecutive left foot strikes)
+        :param minRightCycles(int)(optional): Minimum number of right cycles
+        :param fullCycle(bool)(optional): Whether the trial has a full gait cycle (7 ordered events)
+        :param channels(list)(optional): Channel labels the trial must all have, e.g. ['LRF', 'Knee Flexion Left']
+        :param pathLike(string)(optional): SQL LIKE pattern on the file path, e.g. '%barefoot%'
+        :param pointsRate(float)(optional): Point frame rate (Hz)
+        :param analogsRate(float)(optional): Analog rate (Hz)
+        :return: paths(list): Sorted file paths
+        """
+        where = ['trials.left_cycles >= ?', 'trials.right_cycles >= ?']
+        params = [minLeftCycles, minRightCycles]
+        for column, value in (('trials.emgset', emgset), ('trials.subject', subject), ('trials.points_rate', pointsRate),
+            ('trials.analogs_rate', analogsRate)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        if fullCycle is not None:
+            where.append('trials.full_cycle = ?')
+            params.append(int(bool(fullCycle)))
+        if pathLike is not None:
+            where.append('files.path LIKE ?')
+            params.append(pathLike)
+        for label in ([channels] if isinstance(channels, str) else channels or []):
+            where.append('EXISTS (SELECT 1 FROM channels WHERE channels.file_id = files.id AND channels.label = ?)')
+            params.append(label)
+
+        sql = 'SELECT files.path FROM files JOIN trials ON trials.file_id = files.id WHERE ' + ' AND '.join(where) + ' ORDER BY files.path'
+        return [row[0] for row in self.db.execute(sql, params)]
+
+    def failedFiles(self):
+        """
+        :return: failed(list): (path, error) of indexed files whose metadata could not be read
+        """
+        return self.query('SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path')
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Index the metadata of c3d trials in a SQLite database and query it.')
+    parser.add_argument('index', help='Index database file')
+    parser.add_argument('source', nargs='?', default=None, help='Directory, glob pattern or c3d file to (re)index')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes (default: cpu count)')
+    parser.add_argument('--emgset', default=None, help="List trials with this EMG system, e.g. 'delsys'")
+    parser.add_argument('--subject', default=None, help='List trials of this subject')
+    parser.add_argument('--min-left', type=int, default=0, help='List trials with at least this many left cycles')
+    parser.add_argument('--min-right', type=int, default=0, help='List trials with at least this many right cycles')
+    parser.add_argument('--full-cycle', action='store_true', default=None, help='List trials with a full gait cycle (7 ordered events)')
+    parser.add_argument('--channels', nargs='+', default=None, help='List trials with all these channels')
+    parser.add_argument('--path-like', default=None, help="List trials whose path matches this SQL LIKE pattern, e.g. '%%barefoot%%'")
+    args = parser.parse_args(argv)
+
+    with TrialIndex(args.index) as index:
+        if args.source is not None:
+            counts = index.update(args.source, workers=args.workers)
+            print(', '.join(f'{count} {name}' for name, count in counts.items()))
+            return 0
+
+        for path in index.findTrials(emgset=args.emgset, subject=args.subject, minLeftCycles=args.min_left,
+            minRightCycles=args.min_right, fullCycle=args.full_cycle, channels=args.channels, pathLike=args.path_like):
+            print(path)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,561 @@
+import io
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+BLOCK_SIZE = 512
+
+# Processor type stored in the parameter section header
+PROCESSOR_INTEL = 84
+PROCESSOR_DEC = 85
+PROCESSOR_MIPS = 86
+
+def _byteorder(processor):
+    if processor == PROCESSOR_MIPS:
+        return '>'
+    return '<'
+
+def _signed(byte):
+    return byte - 256 if byte > 127 else byte
+
+def _decodeFloats(raw, processor, count=None):
+    """
+    Converts raw bytes to IEEE float32 values for the given processor type.
+
+    DEC (VAX F) floats have their 16 bit words swapped relative to little endian IEEE
+    and an exponent bias one higher, i.e. the IEEE interpretation is 4 times too large.
+    """
+    if processor == PROCESSOR_DEC:
+        words = np.frombuffer(raw, dtype='<u2', count=-1 if count is None else 2*count)
+        words = words.reshape(-1, 2)[:, ::-1].copy()
+        values = words.view('<f4').ravel()/np.float32(4)
+        return values.astype(np.float32)
+    return np.frombuffer(raw, dtype=_byteorder(processor) + 'f4', count=-1 if count is None else count)
+
+def readHeader(f):
+    """
+    Reads the 512 byte header block of an open c3d file.
+
+    :param f(file): File opened in binary mode, positioned anywhere
+    :return: header(dict): Raw header fields (frames are 1-based as stored)
+    """
+    f.seek(0)
+    block = f.read(BLOCK_SIZE)
+    if len(block) < BLOCK_SIZE or block[1] != 0x50:
+        raise Exception("Not a valid c3d file (missing header key)")
+
+    # The processor type lives in the parameter section so read it first
+    parameterBlock = block[0]
+    f.seek((parameterBlock-1)*BLOCK_SIZE)
+    paramHead = f.read(4)
+    if len(paramHead) < 4:
+        raise Exception("Not a valid c3d file (parameter section missing)")
+    processor = paramHead[3]
+    order = _byteorder(processor)
+
+    words = np.frombuffer(block[:24], dtype=order + 'u2')
+    header = {
+        'parameter_block': parameterBlock,
+        'parameter_blocks': paramHead[2],
+        'processor': processor,
+        'point_count': int(words[1]),
+        'analog_count': int(words[2]),
+        'first_frame': int(words[3]),
+        'last_frame': int(words[4]),
+        'max_gap': int(words[5]),
+        'scale': float(_decodeFloats(block[12:16], processor, 1)[0]),
+        'data_block': int(words[8]),
+        'analog_per_frame': int(words[9]),
+        'frame_rate': float(_decodeFloats(block[20:24], processor, 1)[0]),
+    }
+    return header
+
+def readParameters(f, header):
+    """
+    Reads the parameter section of an open c3d file.
+
+    Values follow the ezc3d layout, i.e. parameters[GROUP][PARAM]['value'] holds a list of
+    strings for character parameters and a numpy array for numeric parameters.
+
+    :param f(file): File opened in binary mode
+    :param header(dict): Header returned by readHeader
+    :return: parameters(dict): Parameters organised by group name
+    """
+    processor = header['processor']
+    order = _byteorder(processor)
+
+    f.seek((header['parameter_block']-1)*BLOCK_SIZE)
+    section = f.read(max(header['parameter_blocks'], 1)*BLOCK_SIZE)
+
+    groupNames = {}
+    groups = {}
+    params = []
+
+    pos = 4
+    while pos + 2 <= len(section):
+        nchars = abs(_signed(section[pos]))
+        groupId = _signed(section[pos+1])
+        if nchars == 0 or groupId == 0:
+            break
+        name = section[pos+2:pos+2+nchars].decode('latin-1').upper()
+        pos = pos + 2 + nchars
+        offsetPos = pos
+        offset = int(np.frombuffer(section[pos:pos+2], dtype=order + 'i2')[0])
+        pos = pos + 2
+
+        if groupId < 0:
+            nDesc = section[pos]
+            groupNames[-groupId] = name
+            groups.setdefault(name, {})['__METADATA__'] = {'DESCRIPTION': section[pos+1:pos+1+nDesc].decode('latin-1')}
+        else:
+            dtype = _signed(section[pos])
+            ndims = section[pos+1]
+            dims = list(section[pos+2:pos+2+ndims])
+            pos = pos + 2 + ndims
+            size = abs(dtype)*int(np.prod(dims)) if ndims else abs(dtype)
+            raw = section[pos:pos+size]
+            params.append((groupId, name, _decodeValue(raw, dtype, dims, processor)))
+
+        if offset == 0:
+            break
+        pos = offsetPos + offset
+
+    parameters = {}
+    for name, group in groups.items():
+        parameters[name] = group
+    for groupId, name, value in params:
+        group = groupNames.get(groupId)
+        if group is None:
+            continue
+        parameters[group][name] = {'value': value}
+
+    return parameters
+
+def _decodeValue(raw, dtype, dims, processor):
+    order = _byteorder(processor)
+
+    if dtype == -1:
+        text = raw.decode('latin-1')
+        if len(dims) <= 1:
+            return [text.rstrip(' \x00')]
+        width = dims[0]
+        if width == 0:
+            return ['']*int(np.prod(dims[1:]))
+        return [text[i:i+width].rstrip(' \x00') for i in range(0, len(text), width)]
+
+    if dtype == 1:
+        values = np.frombuffer(raw, dtype='u1').astype(np.int64)
+    elif dtype == 2:
+        values = np.frombuffer(raw, dtype=order + 'i2').astype(np.int64)
+    elif dtype == 4:
+        values = _decodeFloats(raw, processor).astype(np.float64)
+    else:
+        raise Exception(f"Unknown c3d parameter type ({dtype})")
+
+    if len(dims) > 1:
+        values = values.reshape(dims, order='F')
+    return values
+
+def _param(parameters, group, name, default=None):
+    try:
+        return parameters[group][name]['value']
+    except KeyError:
+        return default
+
+def _combineWords(value):
+    # TRIAL:ACTUAL_*_FIELD store an unsigned 32 bit frame number as two 16 bit words
+    value = np.asarray(value, dtype=np.int64) & 0xFFFF
+    if len(value) >= 2:
+        return int(value[0] + (value[1] << 16))
+    return int(value[0])
+
+def summariseHeader(header, parameters):
+    """
+    Returns the points and analogs header information in the ezc3d layout (0-based frames).
+
+    :param header(dict): Header returned by readHeader
+    :param parameters(dict): Parameters returned by readParameters
+    :return: summary(dict): 'points' and 'analogs' with size, frame_rate, first_frame and last_frame
+    """
+    first = header['first_frame']
+    last = header['last_frame']
+
+    start = _param(parameters, 'TRIAL', 'ACTUAL_START_FIELD')
+    end = _param(parameters, 'TRIAL', 'ACTUAL_END_FIELD')
+    frames = _param(parameters, 'POINT', 'FRAMES')
+    if start is not None and end is not None and len(start) and len(end):
+        first, last = _combineWords(start), _combineWords(end)
+    elif frames is not None and len(frames) and last == 0xFFFF:
+        last = first + (int(frames[0]) & 0xFFFF) - 1
+
+    ratio = header['analog_per_frame']
+    nanalogs = header['analog_count']//ratio if ratio else 0
+
+    summary = {
+        'points': {
+            'size': header['point_count'],
+            'frame_rate': header['frame_rate'],
+            'first_frame': first-1,
+            'last_frame': last-1},
+        'analogs': {
+            'size': nanalogs,
+            'frame_rate': header['frame_rate']*ratio,
+            'first_frame': (first-1)*ratio,
+            'last_frame': last*ratio-1 if ratio else -1},
+    }
+    return summary
+
+def ReadC3DMetadata(path):
+    """
+    Reads the header and parameter sections of a c3d file without touching the point and analog data.
+
+    The returned dictionary can be indexed like an ezc3d c3d object for 'header' and 'parameters'.
+
+    :param path(string): Absolute or relative path to the c3d file
+    :return: metadata(dict): 'header', 'parameters' and 'raw_header' entries
+    """
+    with open(path, 'rb') as f:
+        header = readHeader(f)
+        parameters = readParameters(f, header)
+
+    metadata = {
+        'header': summariseHeader(header, parameters),
+        'parameters': parameters,
+        'raw_header': header,
+    }
+    return metadata
+
+def _parameterRecords(section, order):
+    # [name, groupId, start, offsetPos, end, dataPos] per record, end is where the next record starts
+    records = []
+    pos = 4
+    while pos + 2 <= len(section):
+        nchars = abs(_signed(section[pos]))
+        groupId = _signed(section[pos+1])
+        if nchars == 0 or groupId == 0:
+            break
+        name = section[pos+2:pos+2+nchars].decode('latin-1').upper()
+        offsetPos = pos + 2 + nchars
+        offset = int(np.frombuffer(section[offsetPos:offsetPos+2], dtype=order + 'i2')[0])
+
+        dataPos = offsetPos + 2
+        if groupId < 0:
+            end = dataPos + 1 + section[dataPos]
+        else:
+            ndims = section[dataPos+1]
+            dims = list(section[dataPos+2:dataPos+2+ndims])
+            size = abs(_signed(section[dataPos]))*int(np.prod(dims)) if ndims else abs(_signed(section[dataPos]))
+            descPos = dataPos + 2 + ndims + size
+            end = descPos + 1 + section[descPos]
+
+        if offset != 0:
+            end = offsetPos + offset
+        records.append([name, groupId, pos, offsetPos, end, dataPos, offset == 0])
+        if offset == 0:
+            break
+        pos = end
+    return records
+
+def _findParameter(records, group, name):
+    groupIds = [-record[1] for record in records if record[1] < 0 and record[0] == group]
+    for record in records:
+        if record[1] > 0 and record[1] in groupIds and record[0] == name:
+            return record
+    return None
+
+@contextmanager
+def AtomicWrite(path, mode='w+b'):
+    """
+    Opens a temporary file next to path, renamed over path when the block completes and removed if it raises,
+    so path is never left partially written.
+
+    :param path(string): Destination file path
+    :param mode(string)(optional): Mode the temporary file is opened with
+    :return: f(file): Temporary file to write
+    """
+    handle, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(handle, mode) as f:
+            yield f
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+def RewriteSubjectName(src, dst=None, subjectname="ANON"):
+    """
+    Replaces SUBJECTS:NAMES in a c3d file by rewriting only the parameter section bytes.
+
+    The point and analog data are copied verbatim. The parameter section only grows, moving the data
+    along by whole blocks, when the new name does not fit in the blocks it already occupies. The file
+    is written through AtomicWrite, so the output (or src, rewritten in place) is never left partial.
+
+    :param src(string): Path to the c3d file
+    :param dst(string)(optional): Path of the anonymised file, None rewrites src in place
+    :param subjectname(string)(optional): Reference to replace the patient name
+    :return: path(string): Path of the anonymised file
+    """
+    encoded = subjectname.encode('latin-1')
+    if len(encoded) > 255:
+        raise Exception("Subject name must be at most 255 characters")
+
+    with open(src, 'rb') as f:
+        header = readHeader(f)
+        order = _byteorder(header['processor'])
+        paramStart = (header['parameter_block']-1)*BLOCK_SIZE
+        nblocks = header['data_block'] - header['parameter_block']
+        if nblocks <= 0:
+            raise Exception(f"{src} has its data section before the parameter section")
+        f.seek(paramStart)
+        section = f.read(nblocks*BLOCK_SIZE)
+
+    records = _parameterRecords(section, order)
+    record = _findParameter(records, 'SUBJECTS', 'NAMES')
+    if record is None:
+        raise Exception(f"{src} has no SUBJECTS:NAMES parameter")
+    _, _, start, offsetPos, end, dataPos, last = record
+
+    # Keep the number of names, replacing each with the subject reference
+    ndims = section[dataPos+1]
+    dims = list(section[dataPos+2:dataPos+2+ndims])
+    size = abs(_signed(section[dataPos]))*int(np.prod(dims)) if ndims else abs(_signed(section[dataPos]))
+    descPos = dataPos + 2 + ndims + size
+    description = section[descPos:descPos+1+section[descPos]]
+    count = int(np.prod(dims[1:])) if ndims > 1 else 1
+    newDims = [len(encoded)] + dims[1:] if ndims > 1 else [len(encoded)]
+
+    body = bytes([0xFF, len(newDims)]) + bytes(newDims) + encoded*count + description
+    offset = 0 if last else 2 + len(body)
+    newRecord = section[start:offsetPos] + np.array([offset], dtype=order + 'i2').tobytes() + body
+
+    used = records[-1][4]
+    newSection = bytearray(section[:start] + newRecord + section[end:used])
+    newBlocks = max(-(-len(newSection)//BLOCK_SIZE), nblocks)
+    newSection += bytes(newBlocks*BLOCK_SIZE - len(newSection))
+
+    shift = newBlocks - nblocks
+    if shift:
+        if newBlocks > 255:
+            raise Exception(f"Parameter section of {src} would exceed 255 blocks")
+        newSection[2] = newBlocks
+        dataStart = _findParameter(_parameterRecords(newSection, order), 'POINT', 'DATA_START')
+        if dataStart is not None and _signed(newSection[dataStart[5]]) == 2:
+            pos = dataStart[5] + 2 + newSection[dataStart[5]+1]
+            value = int(np.frombuffer(newSection[pos:pos+2], dtype=order + 'u2')[0]) + shift
+            newSection[pos:pos+2] = np.array([value], dtype=order + 'u2').tobytes()
+
+    path = src if dst is None else dst
+    with AtomicWrite(path) as out, open(src, 'rb') as f:
+        lead = bytearray(f.read(paramStart))
+        if shift:
+            # Parameter section grew, the data section starts that many blocks later
+            lead[16:18] = np.array([header['data_block'] + shift], dtype=order + 'u2').tobytes()
+        out.write(lead)
+        out.write(newSection)
+        f.seek(paramStart + nblocks*BLOCK_SIZE)
+        shutil.copyfileobj(f, out, 16*1024*1024)
+    return path
+
+def _decToIEEE(values):
+    # Mapped DEC floats are viewed as little endian IEEE, swap the 16 bit words back and rescale
+    values = np.ascontiguousarray(values, dtype='<f4')
+    words = values.view('<u2').reshape(values.shape + (2,))[..., ::-1]
+    return np.ascontiguousarray(words).view('<f4').reshape(values.shape)/np.float32(4)
+
+class MappedPoints:
+    """
+    Points data of a memory-mapped c3d file, indexed like the ezc3d array (4, points, frames).
+
+    Only the indexed region is read from the file and scaled. Rows 0-2 hold X, Y, Z and row 3 is 1
+    (homogeneous), as in ezc3d; coordinates with a negative residual are returned as nan.
+    """
+
+    def __init__(self, raw, scale, processor, isfloat, dtype=np.float64):
+        """
+        :param raw(memmap): Mapped points field of the frames, shape (frames, points, 4)
+        :param scale(float): POINT:SCALE, applied to integer data only
+        :param processor(int): Processor type of the file
+        :param isfloat(bool): True if the data section is stored as floats
+        :param dtype(numpy.dtype)(optional): Type of the returned values
+        :return: None
+        """
+        self.raw = raw
+        self.scale = 1.0 if isfloat else abs(scale)
+        self.processor = processor
+        self.isfloat = isfloat
+        self.dtype = np.dtype(dtype)
+        self.shape = (raw.shape[2], raw.shape[1], raw.shape[0])
+        self._rows = np.arange(4).reshape(4, 1, 1)
+        return
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decode(self, values):
+        if self.isfloat and self.processor == PROCESSOR_DEC:
+            return _decToIEEE(values)
+        return values
+
+    def view(self):
+        """Returns the unscaled points as a zero-copy view of the mapped file, shape (4, points, frames)."""
+        return self.raw.transpose(2, 1, 0)
+
+    def __getitem__(self, key):
+        raw = self.view()
+        rows = np.broadcast_to(self._rows, raw.shape)[key]
+        residual = self._decode(np.broadcast_to(raw[3], raw.shape)[key])
+        values = self._decode(raw[key]).astype(self.dtype)*self.dtype.type(self.scale)
+
+        values = np.where(rows == 3, self.dtype.type(1), values)
+        values = np.where((rows < 3) & (residual < 0), self.dtype.type(np.nan), values)
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:, :, :]
+        return values if dtype is None else values.astype(dtype)
+
+class MappedAnalogs:
+    """
+    Analog data of a memory-mapped c3d file, indexed like the ezc3d array (channels, samples).
+
+    Indexing reads only the frames spanning the requested samples and applies
+    (value - OFFSET) * GEN_SCALE * SCALE for the requested channels.
+    """
+
+    def __init__(self, raw, scale, offset, processor, isfloat, dtype=np.float64):
+        """
+        :param raw(memmap): Mapped analogs field of the frames, shape (frames, samples per frame, channels)
+        :param scale(numpy.array): Per channel scale, ANALOG:GEN_SCALE * ANALOG:SCALE
+        :param offset(numpy.array): Per channel ANALOG:OFFSET
+        :param processor(int): Processor type of the file
+        :param isfloat(bool): True if the data section is stored as floats
+        :param dtype(numpy.dtype)(optional): Type of the returned values
+        :return: None
+        """
+        self.raw = raw
+        self.ratio = raw.shape[1]
+        self.processor = processor
+        self.isfloat = isfloat
+        self.dtype = np.dtype(dtype)
+        self.scale = np.asarray(scale, dtype=self.dtype)
+        self.offset = np.asarray(offset, dtype=self.dtype)
+        self.shape = (raw.shape[2], raw.shape[0]*raw.shape[1])
+        return
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decode(self, values):
+        if self.isfloat and self.processor == PROCESSOR_DEC:
+            return _decToIEEE(values)
+        return values
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, samples = key[0], (key[1] if len(key) > 1 else slice(None))
+        else:
+            rows, samples = key, slice(None)
+
+        # Only read the frames covering a contiguous sample range
+        if isinstance(samples, slice) and samples.step in (None, 1):
+            start, stop, _ = samples.indices(self.shape[1])
+            stop = max(start, stop)
+            firstFrame, lastFrame = start//self.ratio, -(-stop//self.ratio)
+            block = self.raw[firstFrame:lastFrame]
+            trim = slice(start - firstFrame*self.ratio, stop - firstFrame*self.ratio)
+        else:
+            block = self.raw
+            trim = samples
+
+        chans = np.arange(self.shape[0])[rows]
+        values = self._decode(block[:, :, chans]).astype(self.dtype)
+        values = values.reshape((-1,) + np.shape(chans)).T if np.ndim(chans) else values.reshape(-1)
+        values = values[..., trim]
+
+        return (values - self.offset[chans][..., None])*self.scale[chans][..., None] if np.ndim(chans) \
+            else (values - self.offset[chans])*self.scale[chans]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:, :]
+        return values if dtype is None else values.astype(dtype)
+
+class MappedC3D(dict):
+    """
+    Memory-mapped c3d file, indexable like an ezc3d c3d object for 'header', 'parameters' and 'data'.
+
+    data['points'] and data['analogs'][0] are MappedPoints and MappedAnalogs, which read and
+    scale only what is indexed. The mapped frames are also available as a structured array in
+    self.frames for zero-copy access to the stored values.
+    """
+
+    def __init__(self, path, dtype=np.float64, buffer=None):
+        """
+        :param path(string): Absolute or relative path to the c3d file
+        :param dtype(numpy.dtype)(optional): Type of the values returned by the mapped arrays
+        :param buffer(bytes)(optional): Contents of the file already read into memory, used instead of mapping path
+        :return: None
+        """
+        dict.__init__(self)
+
+        with (open(path, 'rb') if buffer is None else io.BytesIO(buffer)) as f:
+            header = readHeader(f)
+            parameters = readParameters(f, header)
+        summary = summariseHeader(header, parameters)
+
+        processor = header['processor']
+        order = _byteorder(processor)
+
+        pointScale = _param(parameters, 'POINT', 'SCALE')
+        pointScale = float(pointScale[0]) if pointScale is not None and len(pointScale) else header['scale']
+        isfloat = pointScale < 0
+
+        npoints = header['point_count']
+        ratio = header['analog_per_frame']
+        nanalogs = summary['analogs']['size']
+        unsigned = 'UNSIGNED' in [f.upper() for f in (_param(parameters, 'ANALOG', 'FORMAT') or [])]
+
+        if isfloat:
+            pointType = analogType = order + 'f4'
+        else:
+            pointType = order + 'i2'
+            analogType = order + ('u2' if unsigned else 'i2')
+
+        frameType = np.dtype([('points', pointType, (npoints, 4)), ('analogs', analogType, (ratio, nanalogs))])
+        nframes = max(summary['points']['last_frame'] - summary['points']['first_frame'] + 1, 0)
+
+        # Truncated files map the frames that are present
+        dataOffset = (header['data_block']-1)*BLOCK_SIZE
+        size = os.path.getsize(path) if buffer is None else len(buffer)
+        available = (size - dataOffset)//frameType.itemsize if frameType.itemsize else 0
+        nframes = min(nframes, max(available, 0))
+
+        if buffer is None:
+            self.frames = np.memmap(path, dtype=frameType, mode='r', offset=dataOffset, shape=(nframes,))
+        else:
+            self.frames = np.frombuffer(buffer, dtype=frameType, count=nframes, offset=dataOffset)
+
+        genScale = _param(parameters, 'ANALOG', 'GEN_SCALE')
+        genScale = float(genScale[0]) if genScale is not None and len(genScale) else 1.0
+        scale = _padded(_param(parameters, 'ANALOG', 'SCALE'), nanalogs, 1.0)
+        offset = _padded(_param(parameters, 'ANALOG', 'OFFSET'), nanalogs, 0.0)
+        if unsigned:
+            offset = np.asarray(offset, dtype=np.int64) & 0xFFFF
+
+        self['header'] = summary
+        self['parameters'] = parameters
+        self['raw_header'] = header
+        self['data'] = {
+            'points': MappedPoints(self.frames['points'], pointScale, processor, isfloat, dtype=dtype),
+            'analogs': [MappedAnalogs(self.frames['analogs'], genScale*np.asarray(scale, dtype=np.float64), offset, processor, isfloat, dtype=dtype)],
+        }
+        return
+
+def _padded(value, size, fill):
+    values = np.full(size, fill, dtype=np.float64)
+    if value is not None:
+        value = np.asarray(value, dtype=np.float64).ravel()[:size]
+        values[:len(value)] = value
+    return values
@@ -0,0 +1,326 @@
+import os
+
+import numpy as np
+
+from c3dreader import AtomicWrite
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+STORE_VERSION = 1
+
+# Which GaitTrial attributes make up each stored channel group, and the cycle slices they use
+DATASETS = {
+    'kinematics': (('KinematicData',), 'Points'),
+    'kinetics': (('PowerData', 'MomentData', 'ForceData'), 'Points'),
+    'emg': (('EMGData',), 'Analogs'),
+}
+
+CYCLES = {'Left': 'LC', 'Right': 'RC', 'Full': 'Full'}
+
+def TrialKey(path, root=None):
+    """
+    Returns the store key for a c3d file, its path (relative to root) without the extension.
+
+    :param path(string): Path to the c3d file
+    :param root(string)(optional): Directory the key is made relative to
+    :return: key(string): Store key, '/' in the path is replaced with ':'
+    """
+    if root is not None:
+        path = os.path.relpath(path, root)
+    key = os.path.splitext(path)[0]
+    return key.replace(os.sep, ':').replace('/', ':')
+
+def TrialMatrices(trial):
+    """
+    Returns the stored channel groups of a trial as (channels x samples) matrices.
+
+    :param trial(GaitTrial): Extracted trial
+    :return: matrices(dict): Group name ('kinematics', 'kinetics', 'emg', 'gps') -> (labels, data), groups without channels are left out
+    """
+    matrices = {}
+    for name, (attrs, _) in DATASETS.items():
+        labels, rows = [], []
+        for attr in attrs:
+            for label, value in getattr(trial, attr, {}).items():
+                labels.append(label)
+                rows.append(value)
+        if labels:
+            matrices[name] = (labels, np.stack([np.asarray(row) for row in rows]))
+
+    gps = getattr(trial, 'gpskinematics', {})
+    if len(gps):
+        matrices['gps'] = (list(gps), np.stack([np.asarray(row) for row in gps.values()]))
+    return matrices
+
+def WriteTrialNpz(trial, path, source=None):
+    """
+    Writes a GaitTrial to a compressed .npz file, the single file counterpart of TrialStore.addTrial.
+
+    Holds '{group}' (channels x samples) and '{group}_labels' arrays per channel group, the events
+    as 'event_*' columns and the cycle slices as '{cycle}_{Points|Analogs}' [start, stop] pairs.
+    The file is written through c3dreader.AtomicWrite so it is never left partially written.
+
+    :param trial(GaitTrial): Extracted trial
+    :param path(string): Output .npz path
+    :param source(string)(optional): Path of the c3d file, kept as 'source'
+    :return: None
+    """
+    arrays = {
+        'source': np.array(source or ''),
+        'subject': np.array(getattr(trial, 'SubjectName', None) or ''),
+        'PointsFrequency': np.array(trial.PointsFrequency),
+        'AnalogsFrequency': np.array(trial.AnalogsFrequency),
+    }
+    for cycle, prefix in CYCLES.items():
+        for kind in ('Points', 'Analogs'):
+            cycleSlice = getattr(trial, f'{prefix}_Slice_{kind}')
+            arrays[f'{cycle}_{kind}'] = np.array([cycleSlice.start, cycleSlice.stop])
+
+    for name, (labels, data) in TrialMatrices(trial).items():
+        arrays[name] = data
+        arrays[f'{name}_labels'] = np.array(labels)
+
+    eventdata = trial.eventdata
+    arrays['event_time'] = np.array([e[0] for e in eventdata], dtype=np.float64)
+    arrays['event_context'] = np.array([e[1] for e in eventdata])
+    arrays['event_label'] = np.array([e[2] for e in eventdata])
+    arrays['event_point_frame'] = np.array([e[3] for e in eventdata], dtype=np.int64)
+    arrays['event_analog_frame'] = np.array([e[4] for e in eventdata], dtype=np.int64)
+
+    with AtomicWrite(path) as f:
+        np.savez_compressed(f, **arrays)
+    return
+
+class TrialStore:
+    """
+    Compressed, chunked HDF5 store of GaitTrial contents.
+
+    Each trial is a group holding one (channels x samples) dataset per channel group
+    ('kinematics', 'kinetics', 'emg', 'gps'), the events as columns and the cycle slices as
+    attributes. Datasets are chunked per channel so a single channel, or a single cycle of a
+    channel, is read without loading the rest of the trial.
+    """
+
+    def __init__(self, path, mode='a', compression='gzip', compression_opts=4):
+        """
+        :param path(string): Path to the store file (.h5)
+        :param mode(string)(optional): 'r' read only, 'a' read/write (create if missing), 'w' overwrite
+        :param compression(string)(optional): HDF5 compression filter, None to disable
+        :param compression_opts(int)(optional): Compression level
+        :return: None
+        """
+        if h5py is None:
+            raise Exception("TrialStore requires h5py, install it with 'pip install h5py'")
+
+        self.path = path
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.h5 = h5py.File(path, mode)
+        if mode != 'r' and 'version' not in self.h5.attrs:
+            self.h5.attrs['version'] = STORE_VERSION
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.h5.close()
+        return
+
+    def __contains__(self, key):
+        return key in self.h5
+
+    def __len__(self):
+        return len(self.h5)
+
+    def keys(self):
+        return list(self.h5.keys())
+
+    def _writeMatrix(self, group, name, labels, data):
+        chunks = (1, max(min(data.shape[1], 16384), 1))
+        dset = group.create_dataset(name, data=data, chunks=chunks, shuffle=self.compression is not None,
+            compression=self.compression, compression_opts=self.compression_opts)
+        dset.attrs['labels'] = np.array(labels, dtype=h5py.string_dtype())
+        return
+
+    def addTrial(self, trial, key, overwrite=False, source=None):
+        """
+        Writes a GaitTrial to the store.
+
+        :param trial(GaitTrial): Extracted trial
+        :param key(string): Key of the trial within the store, see TrialKey
+        :param overwrite(bool)(optional): Replace the trial if the key already exists
+        :param source(string)(optional): Path of the c3d file, kept as an attribute
+        :return: None
+        """
+        if key in self.h5:
+            if not overwrite:
+                raise Exception(f"Trial {key} already in store {self.path}")
+            del self.h5[key]
+
+        group = self.h5.create_group(key)
+        group.attrs['source'] = source or ''
+        group.attrs['subject'] = getattr(trial, 'SubjectName', None) or ''
+        group.attrs['emgset'] = getattr(trial, 'emgset', '')
+        group.attrs['PointsFrequency'] = trial.PointsFrequency
+        group.attrs['AnalogsFrequency'] = trial.AnalogsFrequency
+
+        for cycle, prefix in CYCLES.items():
+            for kind in ('Points', 'Analogs'):
+                cycleSlice = getattr(trial, f'{prefix}_Slice_{kind}')
+                group.attrs[f'{cycle}_{kind}'] = [cycleSlice.start, cycleSlice.stop]
+
+        for name, (labels, data) in TrialMatrices(trial).items():
+            self._writeMatrix(group, name, labels, data)
+
+        # All-cycle tensors, only when they have already been computed (see GaitTrial.ExtractAllCycles)
+        for side, tensors in vars(trial).get('CycleData', {}).items():
+            for name, tensor in tensors.items():
+                if tensor.size == 0:
+                    continue
+                dset = group.create_dataset(f'cycles/{side}/{name}', data=tensor, chunks=(1, 1, tensor.shape[2]),
+                    shuffle=self.compression is not None, compression=self.compression, compression_opts=self.compression_opts)
+                dset.attrs['labels'] = np.array(trial.CycleLabels[name], dtype=h5py.string_dtype())
+
+        events = group.create_group('events')
+        eventdata = trial.eventdata
+        events.create_dataset('time', data=np.array([e[0] for e in eventdata], dtype=np.float64))
+        events.create_dataset('context', data=np.array([e[1] for e in eventdata], dtype=h5py.string_dtype()))
+        events.create_dataset('label', data=np.array([e[2] for e in eventdata], dtype=h5py.string_dtype()))
+        events.create_dataset('point_frame', data=np.array([e[3] for e in eventdata], dtype=np.int64))
+        events.create_dataset('analog_frame', data=np.array([e[4] for e in eventdata], dtype=np.int64))
+        return
+
+    def labels(self, key, group):
+        """
+        Returns the channel labels stored for a trial and channel group.
+
+        :param key(string): Trial key
+        :param group(string): 'kinematics', 'kinetics', 'emg' or 'gps'
+        :return: labels(list): Channel labels in row order
+        """
+        if group not in self.h5[key]:
+            return []
+        return [label.decode() if isinstance(label, bytes) else label for label in self.h5[key][group].attrs['labels']]
+
+    def cycleSlice(self, key, group, cycle):
+        """
+        Returns the sample slice of a cycle for a channel group.
+
+        :param key(string): Trial key
+        :param group(string): 'kinematics', 'kinetics' or 'emg'
+        :param cycle(string): 'Left', 'Right' or 'Full'
+        :return: slice(slice): Samples of the cycle
+        """
+        kind = DATASETS[group][1]
+        start, stop = self.h5[key].attrs[f'{cycle}_{kind}']
+        return slice(int(start), int(stop), 1)
+
+    def readChannel(self, key, group, channel, cycle=None):
+        """
+        Reads one channel of one trial, optionally only the samples of a cycle.
+
+        :param key(string): Trial key
+        :param group(string): 'kinematics', 'kinetics', 'emg' or 'gps'
+        :param channel(string): Channel label, e.g. 'Knee Flexion Left' or 'LRF'
+        :param cycle(string)(optional): 'Left', 'Right' or 'Full', None for the whole recording
+        :return: data(numpy.array): Channel samples
+        """
+        labels = self.labels(key, group)
+        if channel not in labels:
+            raise KeyError(f'{channel} not stored for {key}/{group}')
+        row = labels.index(channel)
+
+        samples = slice(None) if (cycle is None or group == 'gps') else self.cycleSlice(key, group, cycle)
+        return self.h5[key][group][row, samples]
+
+    def loadChannel(self, group, channel, cycle=None, keys=None):
+        """
+        Reads one channel across many trials.
+
+        :param group(string): 'kinematics', 'kinetics', 'emg' or 'gps'
+        :param channel(string): Channel label
+        :param cycle(string)(optional): 'Left', 'Right' or 'Full', None for the whole recording
+        :param keys(list)(optional): Trial keys to read, all trials by default
+        :return: data(dict): Trial key -> channel samples, trials without the channel are skipped
+        """
+        data = {}
+        for key in (self.keys() if keys is None else keys):
+            try:
+                data[key] = self.readChannel(key, group, channel, cycle=cycle)
+            except KeyError:
+                pass
+        return data
+
+    def readCycles(self, key, side, group, channel=None):
+        """
+        Reads the all-cycle tensor of a trial (see GaitTrial.ExtractAllCycles).
+
+        :param key(string): Trial key
+        :param side(string): 'Left' or 'Right'
+        :param group(string): 'kinematics', 'kinetics' or 'emg'
+        :param channel(string)(optional): Only read this channel
+        :return: cycles(numpy.array): (cycles x channels x samples), or (cycles x samples) for one channel
+        """
+        dset = self.h5[key]['cycles'][side][group]
+        if channel is None:
+            return dset[()]
+        labels = [label.decode() if isinstance(label, bytes) else label for label in dset.attrs['labels']]
+        return dset[:, labels.index(channel), :]
+
+    def readEvents(self, key):
+        """
+        Returns the events of a trial in the GaitTrial.eventdata layout.
+
+        :param key(string): Trial key
+        :return: eventdata(list): [time, context, label, point frame, analog frame] per event
+        """
+        events = self.h5[key]['events']
+        columns = [events['time'][()], events['context'].asstr()[()], events['label'].asstr()[()],
+            events['point_frame'][()], events['analog_frame'][()]]
+        return [[float(t), c, l, int(p), int(a)] for t, c, l, p, a in zip(*columns)]
+
+    def readTrial(self, key, cycle=None):
+        """
+        Reads all the stored channels of a trial.
+
+        :param key(string): Trial key
+        :param cycle(string)(optional): 'Left', 'Right' or 'Full', None for the whole recording
+        :return: trial(dict): Attributes, events and a label -> samples dict per channel group
+        """
+        group = self.h5[key]
+        trial = dict(group.attrs)
+        trial['eventdata'] = self.readEvents(key)
+        for name in list(DATASETS) + ['gps']:
+            if name not in group:
+                continue
+            samples = slice(None) if (cycle is None or name == 'gps') else self.cycleSlice(key, name, cycle)
+            data = group[name][:, samples]
+            trial[name] = dict(zip(self.labels(key, name), data))
+        return trial
+
+def ExportTrials(results, storepath, root=None, overwrite=False):
+    """
+    Writes the successful results of a batch extraction to a TrialStore.
+
+    :param results(iterable): BatchResult objects, e.g. from c3dbatch.ExtractBatchData
+    :param storepath(string): Path to the store file
+    :param root(string)(optional): Directory the trial keys are made relative to
+    :param overwrite(bool)(optional): Replace trials already in the store
+    :return: failed(list): BatchResult objects that could not be extracted
+    """
+    failed = []
+    with TrialStore(storepath) as store:
+        for result in results:
+            if not result.ok:
+                failed.append(result)
+                continue
+            store.addTrial(result.trial, TrialKey(result.path, root=root), overwrite=overwrite, source=result.path)
+    return failed
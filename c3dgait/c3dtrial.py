@@ -1,7 +1,15 @@
 from ezc3d import c3d 
 import numpy as np
-from scipy import signal
+from scipy import signal, interpolate
 import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from c3dreader import ReadC3DMetadata, MappedC3D, RewriteSubjectName
+
+__version__ = '1.1.0'
 
 class Anonymise:
     """This class removes the patient identifiable data from the c3d file."""
@@ -36,23 +44,8 @@ class Anonymise:
         
         :return: fielpath(String): Output file path
         """
-        # Create file name
-        filename= self.trialC3D['parameters']['SUBJECTS']['NAMES']['value']
-        if condition!=None:
-            filename = "{}_{}".format(filename, condition)
-        else:
-            pass
-
-        if trialno!=None:
-            filename  = "{}_{}.c3d".format(filename, trialno)
-        else:
-            filename  = "{}.c3d".format(filename)
-        
-        if outputdir!=None:
-            filepath = os.path.join(outputdir, filename)
-        else:
-            filepath = filename
-        return filepath
+        subjectname = self.trialC3D['parameters']['SUBJECTS']['NAMES']['value']
+        return AnonymisedFilePath(subjectname, outputdir, condition, trialno)
 
     def saveC3D(self, outputdir=None, condition=None, trialno=None):
         """
@@ -67,8 +60,435 @@ class Anonymise:
         self.trialC3D.write(fpath)
         return
 
+def AnonymisedFilePath(subjectname, outputdir=None, condition=None, trialno=None):
+    """
+    Returns a file path for an anonymised c3d file.
+    Format "{outputdir}/{subjectname}_{condition}_{trialno}.c3d
+
+    :param subjectname(String): Subject reference
+    :param outputdir(String)(optional): Absolute or relative path to chosen directory
+    :param condition(String)(optional): Trial condition e.g barefoot
+    :param trialno(int)(optional): Trial number
+    :return: filepath(String): Output file path
+    """
+    filename = subjectname if isinstance(subjectname, str) else subjectname[0]
+    if condition!=None:
+        filename = "{}_{}".format(filename, condition)
+
+    if trialno!=None:
+        filename  = "{}_{}.c3d".format(filename, trialno)
+    else:
+        filename  = "{}.c3d".format(filename)
+
+    if outputdir!=None:
+        return os.path.join(outputdir, filename)
+    return filename
+
+def AnonymiseC3D(c3dPath, outputdir=None, condition=None, trialno=None, subjectname="ANON"):
+    """
+    Saves an anonymised copy of a c3d file without decoding it, only the SUBJECTS:NAMES parameter bytes are
+    rewritten and the point and analog data are copied verbatim (see c3dreader.RewriteSubjectName).
+    Produces the same file name as Anonymise.saveC3D.
+
+    :param c3dPath(string): Absolute or relative path to the c3d file
+    :param outputdir(String)(optional): Absolute or relative path to chosen directory
+    :param condition(String)(optional): Trial condition e.g barefoot
+    :param trialno(int)(optional): Trial number
+    :param subjectname(string)(optional): Reference to replace the patient name
+    :return: filepath(String): Path of the anonymised file
+    """
+    filepath = AnonymisedFilePath(subjectname, outputdir, condition, trialno)
+    return RewriteSubjectName(c3dPath, filepath, subjectname)
+
+# Kinematic channel ({label}_{component}) -> name used in the gait datasets
+KINEMATIC_CHANNELS = {
+    'LPelvisAngles_0':'Pelvic Tilt Left', 
+    'RPelvisAngles_0':'Pelvic Tilt Right', 
+    'LHipAngles_0':'Hip Flexion Left', 
+    'RHipAngles_0':'Hip Flexion Right', 
+    'LKneeAngles_0':'Knee Flexion Left', 
+    'RKneeAngles_0':'Knee Flexion Right', 
+    'LAnkleAngles_0':'Ankle Dorsiflexion Left', 
+    'RAnkleAngles_0':'Ankle Dorsiflexion Right', 
+    'LPelvisAngles_1':'Pelvic Obliquity Left', 
+    'RPelvisAngles_1':'Pelvic Obliquity Right', 
+    'LHipAngles_1':'Hip Abduction Left', 
+    'RHipAngles_1':'Hip Abduction Right', 
+    'LPelvisAngles_2':'Pelvic Rotation Left', 
+    'RPelvisAngles_2':'Pelvic Rotation Right',
+    'LHipAngles_2':'Hip Rotation Left',
+    'RHipAngles_2':'Hip Rotation Right', 
+    'LFootProgressAngles_2':'Foot Progression Left', 
+    'RFootProgressAngles_2':'Foot Progression Right'}
+
+# EMG label conversion for each EMG system, see AnalogsData.CheckEMGLabelset
+EMG_LABEL_CONVERSION = {
+    'delsys':{'LRF.IM EMG1': 'LRF',
+        'RVM.IM EMG10': 'RVM',
+        'RSM.IM EMG11': 'RSM',
+        'RST.IM EMG12': 'RST',
+        'RTA.IM EMG13': 'RTA',
+        'RPR.IM EMG14': 'RPR',
+        'RMG.IM EMG15': 'RMG',
+        'RSOL.IM EMG16': 'RSOL',
+        'LVM.IM EMG2': 'LVM',
+        'LSM.IM EMG3': 'LSM',
+        'LST.IM EMG4': 'LST',
+        'LTA.IM EMG5': 'LTA',
+        'LPR.IM EMG6': 'LPR',
+        'LMG.IM EMG7': 'LMG',
+        'LSOL.IM EMG8': 'LSOL',
+        'RRF.IM EMG9': 'RRF'},
+
+    'sys1':{'EMG1': 'EMG1',
+        'EMG2': 'EMG2',
+        'EMG3': 'EMG3',
+        'EMG4': 'EMG4',
+        'EMG5': 'EMG5',
+        'EMG6': 'EMG6',
+        'EMG7': 'EMG7',
+        'EMG8': 'EMG8',
+        'EMG9': 'EMG9',
+        'EMG10': 'EMG10',
+        'EMG11': 'EMG11',
+        'EMG12': 'EMG12'},
+
+    'sys2':{'Voltage.EMG1': 'Voltage.EMG1',
+        'Voltage.EMG2': 'Voltage.EMG2',
+        'Voltage.EMG3': 'Voltage.EMG3',
+        'Voltage.EMG4': 'Voltage.EMG4',
+        'Voltage.EMG5': 'Voltage.EMG5',
+        'Voltage.EMG6': 'Voltage.EMG6',
+        'Voltage.EMG7': 'Voltage.EMG7',
+        'Voltage.EMG8': 'Voltage.EMG8',
+        'Voltage.EMG9': 'Voltage.EMG9',
+        'Voltage.EMG10': 'Voltage.EMG10',
+        'Voltage.EMG11': 'Voltage.EMG11',
+        'Voltage.EMG12': 'Voltage.EMG12'},
+
+    'sys3':{'LRF01': 'LRF01',
+        'LMH02': 'LMH02',
+        'BROKEN03': 'BROKEN03',
+        'BROKEN04': 'BROKEN04',
+        'BROKEN05': 'BROKEN05',
+        'BROKEN06': 'BROKEN06',
+        'BROKEN07': 'BROKEN07',
+        'BROKEN08': 'BROKEN08',
+        'RVM09': 'RVM09',
+        'LVM10': 'LVM10',
+        'LTA11': 'LTA11',
+        'LMG12': 'LMG12',
+        'RMG13': 'RMG13',
+        'RTA14': 'RTA14',
+        'RMH15': 'RMH15',
+        'RRF16': 'RRF16'},
+}
+
+class ChannelData:
+    """
+    Channels stored as the rows of a single array with a label -> row index.
+
+    Behaves like a read-only dict of label -> channel samples (row views of data), so
+    slicing every channel for a cycle is a single array operation.
+    """
+
+    __slots__ = ('labels', 'data', 'index')
+
+    def __init__(self, labels, data):
+        """
+        :param labels(iterable): Channel labels in row order
+        :param data(numpy.array): Channel data (channels x samples)
+        :return: None
+        """
+        self.labels = list(labels)
+        self.data = np.asarray(data)
+        self.index = {label: row for row, label in enumerate(self.labels)}
+        if len(self.labels) != self.data.shape[0]:
+            raise Exception(f"{len(self.labels)} labels given for {self.data.shape[0]} channels")
+        return
+
+    @classmethod
+    def fromDict(cls, channels):
+        """
+        :param channels(dict): Label -> channel samples, all the same length
+        :return: ChannelData
+        """
+        if not channels:
+            return cls([], np.empty((0, 0)))
+        return cls(channels, np.stack([np.asarray(value) for value in channels.values()]))
+
+    def __getitem__(self, label):
+        return self.data[self.index[label]]
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return f'ChannelData({len(self.labels)} channels x {self.data.shape[-1] if self.data.ndim > 1 else 0} samples)'
+
+    def get(self, label, default=None):
+        return self[label] if label in self.index else default
+
+    def keys(self):
+        return list(self.labels)
+
+    def values(self):
+        return list(self.data)
+
+    def items(self):
+        return list(zip(self.labels, self.data))
+
+    def slice(self, samples):
+        """Returns all channels for a range of samples, as a view of data."""
+        return ChannelData(self.labels, self.data[:, samples])
+
+    def select(self, labels):
+        """Returns a copy holding only the given channels, in the given order."""
+        labels = list(labels)
+        return ChannelData(labels, self.data[[self.index[label] for label in labels]])
+
+def AsChannelData(channels):
+    """Returns channels as ChannelData, converting a dict of label -> samples if needed."""
+    if isinstance(channels, ChannelData):
+        return channels
+    return ChannelData.fromDict(channels)
+
+def NormaliseCycles(data, samples, normalisation='fft'):
+    """
+    Time normalises each row of a (channels x samples) array to a fixed number of samples.
+
+    The modes put the output samples at different points of the cycle. 'linear' and 'cubic' span the first
+    to the last input sample, output k is at k/(samples-1) of the cycle (0% to 100%). 'fft' treats the
+    input as one period, output k is at input sample k*n/samples, so the last output falls short of the
+    last input sample. Switching mode therefore shifts the cycle percentage of every output sample but the first.
+
+    :param data(numpy.array): Channel data, the last axis is time
+    :param samples(int): Number of samples to normalise to
+    :param normalisation(string)(optional): 'fft' (scipy.signal.resample), 'linear' or 'cubic' interpolation
+    :return: normalised(numpy.array): Array with the last axis resampled to samples, float32 data stays float32
+    """
+    data = np.asarray(data)
+    n = data.shape[-1]
+
+    if normalisation == 'fft':
+        return _KeepFloatType(signal.resample(data, samples, axis=-1), data)
+    elif normalisation not in ('linear', 'cubic'):
+        raise Exception(f"Unknown normalisation ({normalisation}), use 'fft', 'linear' or 'cubic'")
+
+    if n < 2:
+        return np.repeat(data, samples, axis=-1)
+
+    # Interpolation maps the first and last samples of the cycle onto the first and last output samples
+    position = np.linspace(0, n-1, samples)
+
+    if normalisation == 'linear':
+        lower = np.minimum(position.astype(int), n-2)
+        weight = (position - lower).astype(data.dtype if data.dtype.kind == 'f' else np.float64)
+        return data[..., lower]*(1-weight) + data[..., lower+1]*weight
+    else:
+        return _KeepFloatType(interpolate.CubicSpline(np.arange(n), data, axis=-1)(position), data)
+
+def _KeepFloatType(result, data):
+    # Filtering and resampling compute in float64, return float32 data as float32
+    if data.dtype.kind == 'f' and result.dtype != data.dtype:
+        return result.astype(data.dtype)
+    return result
+
+@lru_cache(maxsize=64)
+def ButterSOS(order, cutoff, fs, btype):
+    """
+    Returns Butterworth filter coefficients in second order sections, cached by design parameters.
+
+    :param order(int): Filter order
+    :param cutoff(float): Cutoff frequency in Hz
+    :param fs(float): Sampling frequency in Hz
+    :param btype(string): 'high' or 'low'
+    :return: sos(numpy.array): Second order sections
+    """
+    return signal.butter(order, cutoff, btype, fs=fs, output='sos')
+
+def EMGEnvelope(data, fs, highpass=40, lowpass=8, order=4, downsample=100, normalisation='fft'):
+    """
+    Computes the linear envelope of every channel of an EMG matrix in one pass:
+    high pass, full wave rectification, low pass, normalisation to the channel maximum and downsampling.
+
+    :param data(numpy.array): EMG data (channels x samples), or a single channel
+    :param fs(float): Sampling frequency in Hz
+    :param highpass(float)(optional): High pass cutoff in Hz
+    :param lowpass(float)(optional): Low pass (envelope) cutoff in Hz
+    :param order(int)(optional): Butterworth filter order
+    :param downsample(float)(optional): Output sampling frequency in Hz, None to keep fs
+    :param normalisation(string)(optional): Downsampling method, see NormaliseCycles
+    :return: envelope(numpy.array): Processed EMG with the same leading shape as data
+    """
+    data = np.asarray(data)
+
+    hp = signal.sosfiltfilt(ButterSOS(order, float(highpass), float(fs), 'high'), data, axis=-1)
+    np.abs(hp, out=hp)
+    envelope = signal.sosfiltfilt(ButterSOS(order, float(lowpass), float(fs), 'low'), hp, axis=-1)
+
+    envelope /= envelope.max(axis=-1, keepdims=True)
+    envelope = _KeepFloatType(envelope, data)
+
+    if downsample is None:
+        return envelope
+    samples = int((data.shape[-1]/fs)*downsample)
+    return NormaliseCycles(envelope, samples, normalisation)
+
+def _StreamBlocks(start, stop, blocksize):
+    for blockStart in range(start, stop, blocksize):
+        yield blockStart, min(blockStart + blocksize, stop)
+
+def _InterpolateBlock(block, blockStart, positions):
+    # Linear interpolation of block (covering samples from blockStart) at absolute sample positions
+    lower = np.floor(positions).astype(int) - blockStart
+    lower = np.clip(lower, 0, block.shape[-1]-1)
+    upper = np.minimum(lower + 1, block.shape[-1]-1)
+    weight = positions - (lower + blockStart)
+    return block[..., lower]*(1-weight) + block[..., upper]*weight
+
+def _OutputPositions(blockStart, blockStop, start, fs, rate, total):
+    # Output samples k sit at input position start + k*fs/rate, return those falling in [blockStart, blockStop)
+    first = int(np.ceil((blockStart - start)*rate/fs))
+    last = min(int(np.ceil((blockStop - start)*rate/fs)), total)
+    return start + np.arange(first, last)*(fs/rate)
+
+def StreamEMGEnvelope(analogs, fs, rows, start=0, stop=None, blocksize=None, overlap=None,
+    highpass=40, lowpass=8, order=4, downsample=100, normalise=True):
+    """
+    Generator computing the EMG linear envelope (see EMGEnvelope) block by block, so memory stays
+    bounded by the block size whatever the recording length.
+
+    Each block is filtered with `overlap` extra samples either side which are then discarded, so the
+    zero-phase filtering matches the whole-recording result away from the recording edges.
+    Downsampling is by linear interpolation onto the output rate. Normalising to the channel maximum
+    needs the maximum of the whole recording, so with normalise=True the source is read twice.
+
+    :param analogs(numpy.array or MappedAnalogs): Analog data (channels x samples), indexed as analogs[rows, start:stop]
+    :param fs(float): Sampling frequency in Hz
+    :param rows(list): Analog rows to process
+    :param start(int)(optional): First sample to process
+    :param stop(int)(optional): Sample to stop at, the end of the recording by default
+    :param blocksize(int)(optional): Samples per block, 10 seconds by default
+    :param overlap(int)(optional): Samples of overlap either side of each block, 1 second by default
+    :param normalise(bool or numpy.array)(optional): True to normalise to each channel's maximum, or the per channel divisors
+    :return: blocks(generator): Envelope blocks (channels x samples)
+    """
+    if stop is None:
+        stop = analogs.shape[-1]
+    if blocksize is None:
+        blocksize = int(10*fs)
+    if overlap is None:
+        overlap = int(fs)
+
+    hp = ButterSOS(order, float(highpass), float(fs), 'high')
+    lp = ButterSOS(order, float(lowpass), float(fs), 'low')
+
+    def envelopeBlocks():
+        for blockStart, blockStop in _StreamBlocks(start, stop, blocksize):
+            readStart, readStop = max(start, blockStart-overlap), min(stop, blockStop+overlap)
+            block = np.asarray(analogs[rows, readStart:readStop], dtype=np.float64)
+            block = signal.sosfiltfilt(hp, block, axis=-1)
+            np.abs(block, out=block)
+            block = signal.sosfiltfilt(lp, block, axis=-1)
+            yield blockStart, blockStop, readStart, block
+
+    if normalise is True:
+        scale = np.zeros(len(rows))
+        for blockStart, blockStop, readStart, block in envelopeBlocks():
+            scale = np.maximum(scale, block[:, blockStart-readStart:blockStop-readStart].max(axis=-1))
+    elif normalise is False or normalise is None:
+        scale = np.ones(len(rows))
+    else:
+        scale = np.asarray(normalise, dtype=np.float64)
+
+    total = int(((stop-start)/fs)*downsample) if downsample is not None else None
+    for blockStart, blockStop, readStart, block in envelopeBlocks():
+        block /= scale[:, None]
+        if downsample is None:
+            yield block[:, blockStart-readStart:blockStop-readStart]
+        else:
+            positions = _OutputPositions(blockStart, blockStop, start, fs, downsample, total)
+            yield _InterpolateBlock(block, readStart, positions)
+    return
+
+def StreamResample(analogs, fs, resample, rows, start=0, stop=None, blocksize=None):
+    """
+    Generator resampling analog channels to a new frequency block by block, by linear interpolation.
+
+    :param analogs(numpy.array or MappedAnalogs): Analog data (channels x samples), indexed as analogs[rows, start:stop]
+    :param fs(float): Sampling frequency in Hz
+    :param resample(float): Output frequency in Hz
+    :param rows(list): Analog rows to process
+    :param start(int)(optional): First sample to process
+    :param stop(int)(optional): Sample to stop at, the end of the recording by default
+    :param blocksize(int)(optional): Samples per block, 10 seconds by default
+    :return: blocks(generator): Resampled blocks (channels x samples)
+    """
+    if stop is None:
+        stop = analogs.shape[-1]
+    if blocksize is None:
+        blocksize = int(10*fs)
+
+    total = int(((stop-start)/fs)*resample)
+    for blockStart, blockStop in _StreamBlocks(start, stop, blocksize):
+        # One extra sample so the last positions of the block can be interpolated
+        readStop = min(stop, blockStop+1)
+        block = np.asarray(analogs[rows, blockStart:readStop], dtype=np.float64)
+        positions = _OutputPositions(blockStart, blockStop, start, fs, resample, total)
+        yield _InterpolateBlock(block, blockStart, positions)
+    return
+
+def CycleTensor(data, frames, samples, normalisation='linear'):
+    """
+    Time normalises every cycle of a set of channels into a (cycles x channels x samples) array.
+
+    Linear normalisation is a single vectorised gather over all cycles; 'fft' and 'cubic'
+    normalise each cycle in turn with NormaliseCycles.
+
+    :param data(numpy.array): Channel data (channels x frames)
+    :param frames(numpy.array): (cycles x 2) first and last frame (inclusive) of each cycle
+    :param samples(int): Number of samples to normalise each cycle to
+    :param normalisation(string)(optional): 'linear', 'fft' or 'cubic'
+    :return: cycles(numpy.array): Normalised cycles (cycles x channels x samples)
+    """
+    data = np.asarray(data)
+    frames = np.asarray(frames, dtype=int).reshape(-1, 2)
+    dtype = data.dtype if data.dtype.kind == 'f' else np.float64
+
+    if len(frames) == 0 or data.shape[0] == 0 or data.shape[-1] == 0:
+        return np.empty((len(frames), data.shape[0], samples), dtype=dtype)
+
+    if normalisation != 'linear':
+        return np.stack([NormaliseCycles(data[:, start:end+1], samples, normalisation) for start, end in frames])
+
+    last = data.shape[-1]-1
+    # Sample positions of every cycle (cycles x samples), clipped to the recorded frames
+    position = frames[:, :1] + (frames[:, 1:] - frames[:, :1])*np.linspace(0, 1, samples)[None, :]
+    position = np.clip(position, 0, last)
+    lower = np.minimum(position.astype(int), max(last-1, 0))
+    upper = np.minimum(lower+1, last)
+    weight = (position - lower).astype(dtype)
+
+    # (channels x cycles x samples) gathers, moved to cycles first
+    cycles = data[:, lower]*(1-weight) + data[:, upper]*weight
+    return np.ascontiguousarray(cycles.transpose(1, 0, 2))
+
 class PointsData:
 
+    # Type of the pulled channel data, see GaitTrial
+    dtype = np.float64
+
+    # Channel group -> attribute its pulled data is stored in
+    POINT_GROUPS = {'KinematicChannels': 'KinematicData', 'PowerChannels': 'PowerData',
+        'MomentChannels': 'MomentData', 'ForceChannels': 'ForceData'}
+
     def __init__(self, PointsLabels, Groups, PointsData, PointsFrequency=120):
         self.PointsFrequency = PointsFrequency
 
@@ -85,33 +505,16 @@ class PointsData:
         self.MomentLabels = set(Groups['Moments'])
         self.ForceLabels = set(Groups['Forces'])
 
-        self.convertKinematicsChannels = {
-            'LPelvisAngles_0':'Pelvic Tilt Left', 
-            'RPelvisAngles_0':'Pelvic Tilt Right', 
-            'LHipAngles_0':'Hip Flexion Left', 
-            'RHipAngles_0':'Hip Flexion Right', 
-            'LKneeAngles_0':'Knee Flexion Left', 
-            'RKneeAngles_0':'Knee Flexion Right', 
-            'LAnkleAngles_0':'Ankle Dorsiflexion Left', 
-            'RAnkleAngles_0':'Ankle Dorsiflexion Right', 
-            'LPelvisAngles_1':'Pelvic Obliquity Left', 
-            'RPelvisAngles_1':'Pelvic Obliquity Right', 
-            'LHipAngles_1':'Hip Abduction Left', 
-            'RHipAngles_1':'Hip Abduction Right', 
-            'LPelvisAngles_2':'Pelvic Rotation Left', 
-            'RPelvisAngles_2':'Pelvic Rotation Right',
-            'LHipAngles_2':'Hip Rotation Left',
-            'RHipAngles_2':'Hip Rotation Right', 
-            'LFootProgressAngles_2':'Foot Progression Left', 
-            'RFootProgressAngles_2':'Foot Progression Right'}
+        self.convertKinematicsChannels = KINEMATIC_CHANNELS
         return
 
-    def pullPointsData(self,  PointsLabels, PointsData):
-        
-        self.KinematicData = {}
-        self.PowerData = {}
-        self.MomentData = {}
-        self.ForceData = {}
+    def classifyPointsLabels(self, PointsLabels):
+
+        # Maps channel key -> (component, label index) for each group
+        self.KinematicChannels = {}
+        self.PowerChannels = {}
+        self.MomentChannels = {}
+        self.ForceChannels = {}
 
         for labelset, label in enumerate(PointsLabels):
 
@@ -121,61 +524,90 @@ class PointsData:
                     chn = f'{label}_{ind}'
                     if chn in self.convertKinematicsChannels:
                         key = self.convertKinematicsChannels[chn]
-                        value = PointsData[ind, labelset, :]
-
-                        self.KinematicData[key] = value
+                        self.KinematicChannels[key] = (ind, labelset)
                     else:
                         pass
             
             elif label in self.PowerLabels: 
                 for ind in range(0,3):
-                    chn = f'{label}_{ind}'
-                    
-                    key = chn
-                    value = PointsData[ind, labelset, :]
-                    self.PowerData[key] = value
+                    self.PowerChannels[f'{label}_{ind}'] = (ind, labelset)
                     
             elif label in self.MomentLabels: 
                 for ind in range(0,3):
-                    chn = f'{label}_{ind}'
-                    
-                    key = chn
-                    value = PointsData[ind, labelset, :]
-                    self.MomentData[key] = value
+                    self.MomentChannels[f'{label}_{ind}'] = (ind, labelset)
 
             elif label in self.ForceLabels: 
                 for ind in range(0,3):
-                    chn = f'{label}_{ind}'
-                    
-                    key = chn
-                    value = PointsData[ind, labelset, :]
-                    self.ForceData[key] = value
+                    self.ForceChannels[f'{label}_{ind}'] = (ind, labelset)
             
-            # Check if in kinematics         
             else:
                 pass
+
+        self.PointRows = {group: self.pointRows(getattr(self, group)) for group in self.POINT_GROUPS}
         return
 
-    def SliceKinematics(self, LC_Slice, RC_Slice, Full_Slice, NoPointSamples=51):
-        
-        self.Kinematics_LC = {}
-        self.Kinematics_RC = {}
-        self.Kinematics_Full = {}
-        self.gpskinematics = {}
-        for key, value in self.KinematicData.items():
-
-            self.Kinematics_LC[key] = value[LC_Slice]
-            self.Kinematics_RC[key] = value[RC_Slice]
-            self.Kinematics_Full[key] = value[Full_Slice]
-
-            if "Left" in key:
-                self.gpskinematics[key] = list(signal.resample(value[LC_Slice], NoPointSamples))
-            else:
-                self.gpskinematics[key] = list(signal.resample(value[RC_Slice], NoPointSamples))
+    @staticmethod
+    def pointRows(channels):
+        # (labels, components, label indices) that index a channel group out of the points array in one step
+        components = np.array([ind for ind, _ in channels.values()], dtype=np.intp)
+        labelsets = np.array([labelset for _, labelset in channels.values()], dtype=np.intp)
+        components.flags.writeable = False
+        labelsets.flags.writeable = False
+        return list(channels), components, labelsets
+
+    def pullPointsData(self,  PointsLabels, PointsData):
+
+        self.classifyPointsLabels(PointsLabels)
+
+        self.pullPointsChannels(PointsData)
+        return
+
+    def pullPointsChannels(self, PointsData):
+
+        for group, attr in self.POINT_GROUPS.items():
+            setattr(self, attr, self._pullPointsRows(PointsData, *self.PointRows[group]))
+        return
+
+    def _pullPointsRows(self, PointsData, labels, components, labelsets):
+
+        if not labels:
+            return ChannelData([], np.empty((0, 0)))
+
+        # Copy only the classified rows so the full points array can be released
+        return ChannelData(labels, PointsData[components, labelsets, :].astype(self.dtype, copy=False))
+
+    def SliceKinematics(self, LC_Slice, RC_Slice, Full_Slice, NoPointSamples=51, normalisation='fft'):
+
+        kinematics = AsChannelData(self.KinematicData)
+        labels = kinematics.labels
+        data = kinematics.data
+
+        self.Kinematics_LC = kinematics.slice(LC_Slice)
+        self.Kinematics_RC = kinematics.slice(RC_Slice)
+        self.Kinematics_Full = kinematics.slice(Full_Slice)
+
+        # Normalise each side's channels in a single batched resample
+        left = [i for i, key in enumerate(labels) if "Left" in key]
+        right = [i for i, key in enumerate(labels) if "Left" not in key]
+
+        self.gpsKinematicsLabels = labels
+        self.gpsKinematicsData = np.empty((len(labels), NoPointSamples), dtype=data.dtype)
+        if left:
+            self.gpsKinematicsData[left] = NormaliseCycles(data[left, LC_Slice], NoPointSamples, normalisation)
+        if right:
+            self.gpsKinematicsData[right] = NormaliseCycles(data[right, RC_Slice], NoPointSamples, normalisation)
+
+        self.gpskinematics = ChannelData(labels, self.gpsKinematicsData)
         return 
 
 class AnalogsData:
 
+    # Type of the pulled channel data, see GaitTrial
+    dtype = np.float64
+
+    # Attributes the EMG, force plate and other analog channels are pulled into
+    ANALOG_GROUPS = ('EMGData', 'ForceplateData', 'OtherAnalogData')
+
     def __init__(self, AnalogsLabels, AnalogDescriptions, AnalogUnits, AnalogsData, AnalogsFrequency=1000):
 
         self.AnalogDescriptions = AnalogDescriptions # dont think it is needed, maybe to confirm EMG
@@ -239,69 +671,7 @@ class AnalogsData:
 
     def ConvertEMGLabel(self):
 
-        conversionLookup = {
-            'delsys':{'LRF.IM EMG1': 'LRF',
-                'RVM.IM EMG10': 'RVM',
-                'RSM.IM EMG11': 'RSM',
-                'RST.IM EMG12': 'RST',
-                'RTA.IM EMG13': 'RTA',
-                'RPR.IM EMG14': 'RPR',
-                'RMG.IM EMG15': 'RMG',
-                'RSOL.IM EMG16': 'RSOL',
-                'LVM.IM EMG2': 'LVM',
-                'LSM.IM EMG3': 'LSM',
-                'LST.IM EMG4': 'LST',
-                'LTA.IM EMG5': 'LTA',
-                'LPR.IM EMG6': 'LPR',
-                'LMG.IM EMG7': 'LMG',
-                'LSOL.IM EMG8': 'LSOL',
-                'RRF.IM EMG9': 'RRF'},
-
-            'sys1':{'EMG1': 'EMG1',
-                'EMG2': 'EMG2',
-                'EMG3': 'EMG3',
-                'EMG4': 'EMG4',
-                'EMG5': 'EMG5',
-                'EMG6': 'EMG6',
-                'EMG7': 'EMG7',
-                'EMG8': 'EMG8',
-                'EMG9': 'EMG9',
-                'EMG10': 'EMG10',
-                'EMG11': 'EMG11',
-                'EMG12': 'EMG12'},
-
-            'sys2':{'Voltage.EMG1': 'Voltage.EMG1',
-                'Voltage.EMG2': 'Voltage.EMG2',
-                'Voltage.EMG3': 'Voltage.EMG3',
-                'Voltage.EMG4': 'Voltage.EMG4',
-                'Voltage.EMG5': 'Voltage.EMG5',
-                'Voltage.EMG6': 'Voltage.EMG6',
-                'Voltage.EMG7': 'Voltage.EMG7',
-                'Voltage.EMG8': 'Voltage.EMG8',
-                'Voltage.EMG9': 'Voltage.EMG9',
-                'Voltage.EMG10': 'Voltage.EMG10',
-                'Voltage.EMG11': 'Voltage.EMG11',
-                'Voltage.EMG12': 'Voltage.EMG12'},
-
-            'sys3':{'LRF01': 'LRF01',
-                'LMH02': 'LMH02',
-                'BROKEN03': 'BROKEN03',
-                'BROKEN04': 'BROKEN04',
-                'BROKEN05': 'BROKEN05',
-                'BROKEN06': 'BROKEN06',
-                'BROKEN07': 'BROKEN07',
-                'BROKEN08': 'BROKEN08',
-                'RVM09': 'RVM09',
-                'LVM10': 'LVM10',
-                'LTA11': 'LTA11',
-                'LMG12': 'LMG12',
-                'RMG13': 'RMG13',
-                'RTA14': 'RTA14',
-                'RMH15': 'RMH15',
-                'RRF16': 'RRF16'},
-        }
-
-        labelConversion = conversionLookup[self.emgset]
+        labelConversion = EMG_LABEL_CONVERSION[self.emgset]
 
         self.newEMGLabels = []
         for i in range(0, len(self.EmgLabels)):
@@ -315,42 +685,69 @@ class AnalogsData:
     
     def pullAnalogsData(self,AnalogsLabels, AnalogsData):
 
-        self.EMGData = {}
-        self.ForceplateData = {}
-        self.OtherAnalogData = {}
+        self.classifyAnalogRows(AnalogsLabels)
+
+        self.pullAnalogsChannels(AnalogsData)
+        return
+
+    def classifyAnalogRows(self, AnalogsLabels):
+
+        emgConversion = dict(zip(self.EmgLabels, self.newEMGLabels))
+        forceplateLabels = set(self.ForceplateLabels)
+        otherLabels = set(self.OtherAnalogLabels)
+
+        emgChannels, forceplateChannels, otherChannels = [], [], []
 
         for labInd, label in enumerate(AnalogsLabels):
             
             key = label
-            value = AnalogsData[labInd]
 
-            if label in self.EmgLabels:
+            if label in emgConversion:
 
                 # convert label
-                newkey = self.newEMGLabels[self.EmgLabels.index(key)]
-                self.EMGData[newkey] = value
-            elif label in self.ForceplateLabels:
-                self.ForceplateData[key] = value
-            elif label in self.OtherAnalogLabels:
-                self.OtherAnalogData[key] = value
+                emgChannels.append((labInd, emgConversion[key], label))
+            elif label in forceplateLabels:
+                forceplateChannels.append((labInd, key, label))
+            elif label in otherLabels:
+                otherChannels.append((labInd, key, label))
             else:
                 pass
 
+        self.AnalogRows = {attr: self.analogRows(channels) for attr, channels
+            in zip(self.ANALOG_GROUPS, (emgChannels, forceplateChannels, otherChannels))}
+        return
+
+    @staticmethod
+    def analogRows(channels):
+        # (labels, rows, ANALOG:LABELS) that index a channel group out of the analogs array in one step
+        rows = np.array([labInd for labInd, _, _ in channels], dtype=np.intp)
+        rows.flags.writeable = False
+        return [key for _, key, _ in channels], rows, [label for _, _, label in channels]
+
+    def pullAnalogsChannels(self, AnalogsData):
+
+        for attr in self.ANALOG_GROUPS:
+            labels, rows, _ = self.AnalogRows[attr]
+            setattr(self, attr, self._pullAnalogRows(AnalogsData, labels, rows))
         return
+
+    def _pullAnalogRows(self, AnalogsData, labels, rows):
+
+        if not labels:
+            return ChannelData([], np.empty((0, 0)))
+
+        # Copy only the selected rows so the full analogs array can be released
+        return ChannelData(labels, AnalogsData[rows].astype(self.dtype, copy=False))
     
     def SliceEMG(self, LC_Slice, RC_Slice, Full_Slice):
 
-        self.EMG_LC = {}
-        self.EMG_RC = {}
-        self.EMG_Full = {}
-
-        for key, value in self.EMGData.items():
-            self.EMG_LC[key] = value[LC_Slice]
-            self.EMG_RC[key] = value[RC_Slice]
-            self.EMG_Full[key] = value[Full_Slice]
+        emg = AsChannelData(self.EMGData)
+        self.EMG_LC = emg.slice(LC_Slice)
+        self.EMG_RC = emg.slice(RC_Slice)
+        self.EMG_Full = emg.slice(Full_Slice)
         return
 
-    def MSAInputData(self, MSALabels, cycle='Left', resampleType='frequency', resample=1000):
+    def MSAInputData(self, MSALabels, cycle='Left', resampleType='frequency', resample=1000, normalisation='fft'):
         
         
         self.MSALabels = MSALabels
@@ -373,14 +770,104 @@ class AnalogsData:
         # Append channel data
         for key in self.MSALabels:
             if key in emg:
-                value = emg[key]
-                self.MSAData.append(list(signal.resample(value, requiredSamples)))
+                self.MSAData.append(key)
             else:
                 print(f'Missing EMG channel ---> {key}')
-            
-        self.MSAData = np.array(self.MSAData)
+
+        if self.MSAData:
+            self.MSAData = NormaliseCycles(AsChannelData(emg).select(self.MSAData).data, requiredSamples, normalisation)
+        else:
+            self.MSAData = np.array(self.MSAData)
         return
 
+    def EnvelopeEMG(self, cycle='Left', labels=None, highpass=40, lowpass=8, order=4, downsample=100, normalisation='fft'):
+        """
+        Computes the EMG linear envelopes of a cycle for all channels at once, see EMGEnvelope.
+
+        :param cycle(string)(optional): 'Left', 'Right', 'Full' or None for the whole recording
+        :param labels(list)(optional): EMG channels to process, all channels by default
+        :return: None, sets EMGEnvelopeLabels and EMGEnvelopeData (channels x samples)
+        """
+        if cycle=='Left':
+            emg = self.EMG_LC
+        elif cycle=='Right':
+            emg = self.EMG_RC
+        elif cycle=='Full':
+            emg = self.EMG_Full
+        else:
+            emg = self.EMGData
+
+        if labels is None:
+            labels = list(emg)
+        for key in labels:
+            if key not in emg:
+                print(f'Missing EMG channel ---> {key}')
+
+        self.EMGEnvelopeLabels = [key for key in labels if key in emg]
+        if self.EMGEnvelopeLabels:
+            data = AsChannelData(emg).select(self.EMGEnvelopeLabels).data
+            self.EMGEnvelopeData = EMGEnvelope(data, self.AnalogsFrequency, highpass=highpass, lowpass=lowpass,
+                order=order, downsample=downsample, normalisation=normalisation)
+        else:
+            self.EMGEnvelopeData = np.empty((0, 0))
+        return
+
+    def _CycleAnalogRange(self, cycle):
+        if cycle=='Left':
+            cycleSlice = self.LC_Slice_Analogs
+        elif cycle=='Right':
+            cycleSlice = self.RC_Slice_Analogs
+        elif cycle=='Full':
+            cycleSlice = self.Full_Slice_Analogs
+        else:
+            return 0, None
+        return cycleSlice.start, cycleSlice.stop
+
+    def _EMGRows(self, labels):
+        emgLabels, emgRows, _ = self.AnalogRows['EMGData']
+        if labels is None:
+            labels = emgLabels
+
+        index = {}
+        for key, row in zip(emgLabels, emgRows):
+            index.setdefault(key, int(row))
+
+        rows, found = [], []
+        for key in labels:
+            if key in index:
+                rows.append(index[key])
+                found.append(key)
+            else:
+                print(f'Missing EMG channel ---> {key}')
+        return rows, found
+
+    def StreamEnvelopeEMG(self, analogs, cycle=None, labels=None, **kwargs):
+        """
+        Streams the EMG linear envelopes straight from the analog data, see StreamEMGEnvelope.
+
+        :param analogs(numpy.array or MappedAnalogs): Full analog data of the trial, e.g. MappedC3D(path)['data']['analogs'][0]
+        :param cycle(string)(optional): 'Left', 'Right', 'Full' or None for the whole recording
+        :param labels(list)(optional): EMG channels to process, all channels by default
+        :return: blocks(generator): Envelope blocks (channels x samples), rows ordered as EMGStreamLabels
+        """
+        rows, self.EMGStreamLabels = self._EMGRows(labels)
+        start, stop = self._CycleAnalogRange(cycle)
+        return StreamEMGEnvelope(analogs, self.AnalogsFrequency, rows, start=start, stop=stop, **kwargs)
+
+    def StreamMSAInputData(self, analogs, MSALabels, cycle='Left', resample=1000, blocksize=None):
+        """
+        Streams the MSA input data (EMG resampled to a frequency) block by block, see StreamResample.
+
+        :param analogs(numpy.array or MappedAnalogs): Full analog data of the trial
+        :param MSALabels(list): EMG channels to include
+        :param cycle(string)(optional): 'Left', 'Right', 'Full' or None for the whole recording
+        :param resample(float)(optional): Output frequency in Hz
+        :return: blocks(generator): Resampled blocks (channels x samples), rows ordered as MSALabels found
+        """
+        rows, self.MSALabels = self._EMGRows(MSALabels)
+        start, stop = self._CycleAnalogRange(cycle)
+        return StreamResample(analogs, self.AnalogsFrequency, resample, rows, start=start, stop=stop, blocksize=blocksize)
+
 class EventData:
 
     def __init__(self, EventTimes, EventLabels, EventContexts, PointsFirstFrame=0, PointsFrequency=120, AnalogsFirstFrame=0, AnalogsFrequency=1000):
@@ -506,55 +993,496 @@ class EventData:
         self.Full_Slice_Analogs = slice(self.full_cycle[0][4], self.full_cycle[1][4]+1, 1)
         return
 
-class GaitTrial(PointsData, AnalogsData, EventData):
+    def GetAllCycleFrames(self, side):
+        """
+        Returns the frames of every cycle of a side, i.e. each consecutive pair of its foot strikes.
+
+        :param side(string): 'Left' or 'Right'
+        :return: points(numpy.array), analogs(numpy.array): (cycles x 2) first and last frame of each cycle
+        """
+        strikes = [event for event in self.eventdata if (event[1] == side) and (event[2] == "Foot Strike")]
+
+        points = np.array([[start[3], end[3]] for start, end in zip(strikes[:-1], strikes[1:])], dtype=int).reshape(-1, 2)
+        analogs = np.array([[start[4], end[4]] for start, end in zip(strikes[:-1], strikes[1:])], dtype=int).reshape(-1, 2)
+        return points, analogs
+
+class ChannelSchema(PointsData, AnalogsData):
+    """
+    Label classification of a point/analog channel layout, computed once and shared by every trial with that layout.
+
+    Runs the PointsData and AnalogsData label classification (getLabels, classifyPointsLabels,
+    getEMGLabels, CheckEMGLabelset, ConvertEMGLabel, classifyAnalogRows), including the index arrays
+    each channel group is pulled with (PointRows, AnalogRows), and shares the result with trials
+    through apply(). Use GetChannelSchema to get the cached schema for a layout.
+    """
+
+    ATTRIBUTES = ('KinematicLabels', 'PowerLabels', 'MomentLabels', 'ForceLabels', 'convertKinematicsChannels',
+        'KinematicChannels', 'PowerChannels', 'MomentChannels', 'ForceChannels', 'PointRows',
+        'EmgLabels', 'ForceplateLabels', 'OtherAnalogLabels', 'emgset', 'newEMGLabels', 'AnalogRows')
+
+    def __init__(self, PointsLabels, Groups, AnalogsLabels, AnalogDescriptions, AnalogUnits):
+        """
+        :param PointsLabels(tuple): POINT:LABELS
+        :param Groups(dict): 'Angles', 'Powers', 'Moments' and 'Forces' point labels
+        :param AnalogsLabels(tuple): ANALOG:LABELS
+        :param AnalogDescriptions(tuple): ANALOG:DESCRIPTIONS
+        :param AnalogUnits(tuple): ANALOG:UNITS
+        :return: None
+        """
+        self.getLabels(Groups)
+        self.classifyPointsLabels(PointsLabels)
+
+        self.getEMGLabels(AnalogUnits, AnalogsLabels)
+        self.CheckEMGLabelset(AnalogDescriptions, AnalogUnits)
+        self.ConvertEMGLabel()
+        self.classifyAnalogRows(AnalogsLabels)
+        return
+
+    def apply(self, trial):
+        """
+        Sets the classification on a trial, sharing the schema's containers rather than copying them.
+
+        TrialMetadata.selectChannels replaces the containers it narrows instead of modifying them, so the
+        cached schema is never altered by a trial.
+
+        :param trial(TrialMetadata): Trial with this channel layout
+        :return: None
+        """
+        for attr in self.ATTRIBUTES:
+            if hasattr(self, attr):
+                setattr(trial, attr, getattr(self, attr))
+        return
+
+@lru_cache(maxsize=128)
+def CompileChannelSchema(PointsLabels, Angles, Powers, Moments, Forces, AnalogsLabels, AnalogDescriptions, AnalogUnits):
+    """
+    Cached ChannelSchema constructor, all arguments must be tuples. See GetChannelSchema.
+    CompileChannelSchema.cache_info() reports how often a layout was reused.
+    """
+    Groups = {'Angles': Angles, 'Powers': Powers, 'Moments': Moments, 'Forces': Forces}
+    return ChannelSchema(PointsLabels, Groups, AnalogsLabels, AnalogDescriptions, AnalogUnits)
+
+def GetChannelSchema(PointsLabels, Groups, AnalogsLabels, AnalogDescriptions, AnalogUnits):
+    """
+    Returns the ChannelSchema for a channel layout, compiling it only the first time the layout is seen.
+
+    :param PointsLabels(list): POINT:LABELS
+    :param Groups(dict): 'Angles', 'Powers', 'Moments' and 'Forces' point labels
+    :param AnalogsLabels(list): ANALOG:LABELS
+    :param AnalogDescriptions(list): ANALOG:DESCRIPTIONS
+    :param AnalogUnits(list): ANALOG:UNITS
+    :return: schema(ChannelSchema): Classification of the layout
+    """
+    return CompileChannelSchema(tuple(PointsLabels), tuple(Groups['Angles']), tuple(Groups['Powers']),
+        tuple(Groups['Moments']), tuple(Groups['Forces']), tuple(AnalogsLabels), tuple(AnalogDescriptions),
+        tuple(AnalogUnits))
+
+# Channel groups accepted by TrialMetadata.selectChannels
+CHANNEL_GROUPS = ('kinematics', 'kinetics', 'powers', 'moments', 'forces', 'emg', 'forceplate', 'otheranalogs')
+
+def _ArraySizes(name, value, sizes):
+    # Flattens the arrays held by an attribute into name -> shape, dtype and bytes
+    if isinstance(value, ChannelData):
+        value = value.data
+    if isinstance(value, np.ndarray):
+        sizes[name] = {'shape': list(value.shape), 'dtype': str(value.dtype), 'nbytes': int(value.nbytes)}
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _ArraySizes(f'{name}.{key}', item, sizes)
+    return sizes
+
+class StageProfiler:
+    """
+    Records the wall time, traced memory and output array sizes of each stage of a trial's construction.
+
+    Pass profile=True (or a StageProfiler) to ExtractTrialData or GaitTrial; the profiler is then kept
+    as trial.Profiler and lazily computed datasets are recorded when they are first read. Callbacks
+    are called as callback(record, trial) after each stage. Trials built without a profiler use
+    NULL_PROFILER, which records nothing.
+    """
+
+    def __init__(self, callbacks=(), memory=True):
+        """
+        :param callbacks(list)(optional): Functions called as callback(record, trial) after each stage
+        :param memory(bool)(optional): Trace allocations with tracemalloc, slows the stages down while profiling.
+            Memory allocated outside Python and numpy (e.g. by the ezc3d decoder) is not traced
+        :return: None
+        """
+        self.callbacks = list(callbacks)
+        self.memory = memory
+        self.records = []
+        return
+
+    def __getstate__(self):
+        # Callbacks may not be picklable, keep only the records when a trial is pickled
+        state = dict(self.__dict__)
+        state['callbacks'] = []
+        return state
+
+    @contextmanager
+    def stage(self, name, trial=None):
+        """
+        Context manager recording one stage.
+
+        :param name(string): Stage name
+        :param trial(object)(optional): Object the stage sets attributes on, new arrays are recorded
+        :return: None
+        """
+        before = dict(vars(trial)) if trial is not None else {}
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            startBytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+
+        try:
+            yield
+            record = {'stage': name, 'seconds': time.perf_counter() - start}
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record['allocated'] = current - startBytes
+                record['peak'] = peak - startBytes
+        finally:
+            if tracing:
+                tracemalloc.stop()
+
+        sizes = {}
+        if trial is not None:
+            for attr, value in vars(trial).items():
+                if before.get(attr) is not value:
+                    _ArraySizes(attr, value, sizes)
+        record['arrays'] = sizes
+
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record, trial)
+        return
+
+    def report(self):
+        """
+        Returns the recorded stages.
+
+        :return: report(dict): 'stages' (list of records with 'stage', 'seconds', 'allocated', 'peak' and 'arrays'),
+            total 'seconds' and 'allocated' bytes
+        """
+        return {
+            'stages': [dict(record) for record in self.records],
+            'seconds': sum(record['seconds'] for record in self.records),
+            'allocated': sum(record.get('allocated', 0) for record in self.records),
+        }
+
+class _NullProfiler:
+    """Profiler used when profiling is off, its stages do nothing."""
+
+    records = []
+
+    def stage(self, name, trial=None):
+        return nullcontext()
+
+    def report(self):
+        return {'stages': [], 'seconds': 0.0, 'allocated': 0}
+
+NULL_PROFILER = _NullProfiler()
+
+def AsProfiler(profile):
+    """Returns a StageProfiler for profile=True, the profiler itself if one is given, otherwise NULL_PROFILER."""
+    if isinstance(profile, (StageProfiler, _NullProfiler)):
+        return profile
+    return StageProfiler() if profile else NULL_PROFILER
+
+class TrialMetadata(PointsData, AnalogsData, EventData):
+    """Events and channel classification of a trial, built from the c3d parameters only."""
+
+    Profiler = NULL_PROFILER
 
     def __init__(self, c3dobj):
+        """
+        :param c3dobj(c3d or dict): ezc3d object or metadata from c3dreader.ReadC3DMetadata
+        :return: None
+        """
+        parameters = c3dobj['parameters']
 
-        EventData.__init__(self,
-            c3dobj['parameters']['EVENT']['TIMES']['value'][1],
-            c3dobj['parameters']['EVENT']['LABELS']['value'],
-            c3dobj['parameters']['EVENT']['CONTEXTS']['value'],
-            PointsFirstFrame=c3dobj['header']['points']['first_frame'],
-            PointsFrequency=c3dobj['header']['points']['frame_rate'],
-            AnalogsFirstFrame=c3dobj['header']['analogs']['first_frame'],
-            AnalogsFrequency=c3dobj['header']['analogs']['frame_rate'])
-
-        Groups = {'Angles':c3dobj['parameters']['POINT']['ANGLES']['value'],
-            'Powers':c3dobj['parameters']['POINT']['POWERS']['value'],
-            'Moments':c3dobj['parameters']['POINT']['MOMENTS']['value'],
-            'Forces':c3dobj['parameters']['POINT']['FORCES']['value']
+        try:
+            self.SubjectName = parameters['SUBJECTS']['NAMES']['value'][0]
+        except (KeyError, IndexError):
+            self.SubjectName = None
+
+        with self.Profiler.stage('EventData', self):
+            EventData.__init__(self,
+                parameters['EVENT']['TIMES']['value'][1],
+                parameters['EVENT']['LABELS']['value'],
+                parameters['EVENT']['CONTEXTS']['value'],
+                PointsFirstFrame=c3dobj['header']['points']['first_frame'],
+                PointsFrequency=c3dobj['header']['points']['frame_rate'],
+                AnalogsFirstFrame=c3dobj['header']['analogs']['first_frame'],
+                AnalogsFrequency=c3dobj['header']['analogs']['frame_rate'])
+
+        Groups = {'Angles':parameters['POINT']['ANGLES']['value'],
+            'Powers':parameters['POINT']['POWERS']['value'],
+            'Moments':parameters['POINT']['MOMENTS']['value'],
+            'Forces':parameters['POINT']['FORCES']['value']
         }
 
-        PointsData.__init__(self, 
-            c3dobj['parameters']['POINT']['LABELS']['value'], 
-            Groups,
-            c3dobj['data']['points'], 
-            PointsFrequency=c3dobj['header']['points']['frame_rate'])
-
-        AnalogsData.__init__(self,
-            c3dobj['parameters']['ANALOG']['LABELS']['value'],
-            c3dobj['parameters']['ANALOG']['DESCRIPTIONS']['value'],
-            c3dobj['parameters']['ANALOG']['UNITS']['value'],
-            c3dobj['data']['analogs'][0],
-            AnalogsFrequency=c3dobj['header']['analogs']['frame_rate'])
-        
-        self.SliceKinematics(self.LC_Slice_Points, self.RC_Slice_Points, self.Full_Slice_Points)
+        self.PointsFrequency = c3dobj['header']['points']['frame_rate']
+        self.PointsLabels = parameters['POINT']['LABELS']['value']
 
-        self.SliceEMG(self.LC_Slice_Analogs, self.RC_Slice_Analogs, self.Full_Slice_Analogs)
+        self.AnalogsFrequency = c3dobj['header']['analogs']['frame_rate']
+        self.AnalogsLabels = parameters['ANALOG']['LABELS']['value']
+        self.AnalogDescriptions = parameters['ANALOG']['DESCRIPTIONS']['value']
+        self.AnalogUnits = parameters['ANALOG']['UNITS']['value']
 
+        # Label classification is shared by all trials with the same channel layout
+        with self.Profiler.stage('ChannelSchema', self):
+            schema = GetChannelSchema(self.PointsLabels, Groups, self.AnalogsLabels, self.AnalogDescriptions, self.AnalogUnits)
+            schema.apply(self)
+        return
+
+    def selectChannels(self, channels):
+        """
+        Restricts the classified channels to those requested, later data pulls only keep these channels.
+
+        :param channels(string or list): Channel groups ('kinematics', 'kinetics', 'powers', 'moments',
+            'forces', 'emg', 'forceplate', 'otheranalogs') and/or channel labels, e.g. 'Knee Flexion Left' or 'LRF'
+        :return: None
+        """
+        if channels is None:
+            return
+        if isinstance(channels, str):
+            channels = [channels]
+        selection = set(channels)
+
+        def keep(key, *groups):
+            return (key in selection) or any(group in selection for group in groups)
+
+        # Containers and index arrays are shared with the ChannelSchema, only replace those that are narrowed
+        known = set(CHANNEL_GROUPS)
+        pointRows = dict(self.PointRows)
+        for attr, groups in (('KinematicChannels', ('kinematics',)),
+            ('PowerChannels', ('kinetics', 'powers')),
+            ('MomentChannels', ('kinetics', 'moments')),
+            ('ForceChannels', ('kinetics', 'forces'))):
+            channelset = getattr(self, attr)
+            known.update(channelset)
+            kept = {key: value for key, value in channelset.items() if keep(key, *groups)}
+            if len(kept) < len(channelset):
+                setattr(self, attr, kept)
+                pointRows[attr] = self.pointRows(kept)
+        self.PointRows = pointRows
+
+        analogRows = dict(self.AnalogRows)
+
+        def narrowRows(attr, labels):
+            # Keeps the rows of a group whose ANALOG:LABELS entry is still selected
+            groupLabels, rows, originals = analogRows[attr]
+            analogRows[attr] = self.analogRows([(int(row), key, label) for key, row, label
+                in zip(groupLabels, rows, originals) if label in labels])
+
+        emg = [(label, newlabel) for label, newlabel in zip(self.EmgLabels, self.newEMGLabels)
+            if keep(newlabel, 'emg') or label in selection]
+        known.update(self.EmgLabels, self.newEMGLabels, self.ForceplateLabels, self.OtherAnalogLabels)
+        if len(emg) < len(self.EmgLabels):
+            self.EmgLabels = [label for label, _ in emg]
+            self.newEMGLabels = [newlabel for _, newlabel in emg]
+            narrowRows('EMGData', set(self.EmgLabels))
+
+        forceplate = [label for label in self.ForceplateLabels if keep(label, 'forceplate')]
+        if len(forceplate) < len(self.ForceplateLabels):
+            self.ForceplateLabels = forceplate
+            narrowRows('ForceplateData', set(forceplate))
+
+        other = [label for label in self.OtherAnalogLabels if keep(label, 'otheranalogs')]
+        if len(other) < len(self.OtherAnalogLabels):
+            self.OtherAnalogLabels = other
+            narrowRows('OtherAnalogData', set(other))
+        self.AnalogRows = analogRows
+
+        for key in sorted(selection - known):
+            print(f'Channel not found in trial ---> {key}')
+        return
+
+class GaitTrial(TrialMetadata):
+    """
+    Events, channel data and gait cycle datasets of a trial.
+
+    The cycle datasets (Kinematics_LC/RC/Full, gpskinematics, EMG_LC/RC/Full, CycleData) are
+    computed the first time they are read and then kept, unless lazy=False. To only list events
+    and channels without reading any data use ScanTrialMetadata.
+    """
+
+    # Derived dataset -> method computing it on first access
+    LAZY_DATASETS = {
+        'Kinematics_LC': '_sliceKinematics',
+        'Kinematics_RC': '_sliceKinematics',
+        'Kinematics_Full': '_sliceKinematics',
+        'gpskinematics': '_sliceKinematics',
+        'gpsKinematicsData': '_sliceKinematics',
+        'gpsKinematicsLabels': '_sliceKinematics',
+        'EMG_LC': '_sliceEMG',
+        'EMG_RC': '_sliceEMG',
+        'EMG_Full': '_sliceEMG',
+        'CycleData': '_extractAllCycles',
+        'CycleLabels': '_extractAllCycles',
+    }
+
+    def __init__(self, c3dobj, channels=None, NoPointSamples=51, normalisation='fft', allcycles=False, lazy=True, profile=None, dtype=np.float64):
+        """
+        :param c3dobj(c3d or MappedC3D): ezc3d object or memory-mapped file of the trial
+        :param channels(string or list)(optional): Channels to keep, see TrialMetadata.selectChannels. All channels by default
+        :param NoPointSamples(int)(optional): Number of samples the gait cycle kinematics are normalised to
+        :param normalisation(string)(optional): Cycle normalisation, 'fft', 'linear' or 'cubic', used for the gait cycle
+            kinematics and the all-cycle tensors (CycleData)
+        :param allcycles(bool)(optional): Normalise every left and right cycle during construction, see ExtractAllCycles
+        :param lazy(bool)(optional): Compute the cycle datasets on first access rather than during construction
+        :param profile(bool or StageProfiler)(optional): Record the time, memory and arrays of each stage in trial.Profiler
+        :param dtype(numpy.dtype)(optional): Type the channel data is converted to once when pulled, np.float32 halves
+            the memory of the trial and of every dataset derived from it
+        :return: None
+        """
+        if profile:
+            self.Profiler = AsProfiler(profile)
+        self.dtype = np.dtype(dtype)
+
+        TrialMetadata.__init__(self, c3dobj)
+
+        self.NoPointSamples = NoPointSamples
+        self.normalisation = normalisation
+
+        with self.Profiler.stage('selectChannels', self):
+            self.selectChannels(channels)
+
+        with self.Profiler.stage('pullPointsData', self):
+            self.pullPointsChannels(c3dobj['data']['points'])
+
+        with self.Profiler.stage('pullAnalogsData', self):
+            self.pullAnalogsChannels(c3dobj['data']['analogs'][0])
+
+        if not lazy:
+            self._sliceKinematics()
+            self._sliceEMG()
+
+        if allcycles:
+            self._extractAllCycles()
+
+        return
+
+    def __getattr__(self, name):
+        # Only called for attributes not set yet, i.e. derived datasets that have not been computed
+        compute = GaitTrial.LAZY_DATASETS.get(name)
+        if compute is None:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        getattr(self, compute)()
+        return self.__dict__[name]
+
+    def _sliceKinematics(self):
+        with self.Profiler.stage('SliceKinematics', self):
+            self.SliceKinematics(self.LC_Slice_Points, self.RC_Slice_Points, self.Full_Slice_Points,
+                NoPointSamples=self.NoPointSamples, normalisation=self.normalisation)
+        return
+
+    def _sliceEMG(self):
+        with self.Profiler.stage('SliceEMG', self):
+            self.SliceEMG(self.LC_Slice_Analogs, self.RC_Slice_Analogs, self.Full_Slice_Analogs)
+        return
+
+    def _extractAllCycles(self):
+        with self.Profiler.stage('ExtractAllCycles', self):
+            self.ExtractAllCycles(NoPointSamples=self.NoPointSamples, normalisation=self.normalisation)
+        return
+
+    def ExtractAllCycles(self, NoPointSamples=51, NoAnalogSamples=1000, normalisation='linear'):
+        """
+        Normalises every left and right cycle of the trial (not only the first) for kinematics, kinetics and EMG.
+
+        :param NoPointSamples(int)(optional): Samples per cycle for kinematics and kinetics
+        :param NoAnalogSamples(int)(optional): Samples per cycle for EMG
+        :param normalisation(string)(optional): 'linear' (vectorised), 'fft' or 'cubic'
+        :return: None, sets CycleLabels[group] and CycleData[side][group] as (cycles x channels x samples) arrays
+            for the groups 'kinematics', 'kinetics' and 'emg' and sides 'Left' and 'Right'
+        """
+        kinetics = [AsChannelData(self.PowerData), AsChannelData(self.MomentData), AsChannelData(self.ForceData)]
+        kinetics = [data for data in kinetics if len(data)]
+        if kinetics:
+            kinetics = ChannelData([label for data in kinetics for label in data.labels], np.concatenate([data.data for data in kinetics]))
+        else:
+            kinetics = ChannelData([], np.empty((0, 0)))
+
+        groups = {
+            'kinematics': (AsChannelData(self.KinematicData), 0, NoPointSamples),
+            'kinetics': (kinetics, 0, NoPointSamples),
+            'emg': (AsChannelData(self.EMGData), 1, NoAnalogSamples),
+        }
+
+        self.CycleLabels = {name: data.labels for name, (data, _, _) in groups.items()}
+        self.CycleData = {}
+        for side in ('Left', 'Right'):
+            frames = self.GetAllCycleFrames(side)
+            self.CycleData[side] = {name: CycleTensor(data.data, frames[kind], samples, normalisation)
+                for name, (data, kind, samples) in groups.items()}
         return
 
 
 ########
 
-def ExtractTrialData(path):
+def LoadC3D(path, backend='ezc3d', buffer=None, dtype=np.float64):
+    """
+    Opens a c3d file with the chosen reader backend.
+
+    :param path(string): Absolute or relative path to the c3d file
+    :param backend(string)(optional): 'ezc3d' decodes the whole file, 'mmap' maps the data section and only reads what is indexed
+    :param buffer(bytes)(optional): Contents of the file already read into memory, only used by the 'mmap' backend
+    :param dtype(numpy.dtype)(optional): Type of the data returned by the 'mmap' backend, ezc3d always decodes to float64
+    :return: c3dobj(c3d or MappedC3D): Trial object in the ezc3d layout
+    """
+    if backend == 'ezc3d':
+        return c3d(path)
+    elif backend == 'mmap':
+        return MappedC3D(path, dtype=dtype, buffer=buffer)
+    else:
+        raise Exception(f"Unknown c3d backend ({backend}), use 'ezc3d' or 'mmap'")
+
+def ExtractTrialData(path, channels=None, backend='ezc3d', NoPointSamples=51, normalisation='fft', allcycles=False, lazy=True, profile=None, buffer=None, dtype=np.float64):
     
-    c3dobj = c3d(path)
+    profiler = AsProfiler(profile)
+    with profiler.stage('decode'):
+        c3dobj = LoadC3D(path, backend=backend, buffer=buffer, dtype=dtype)
 
-    trial = GaitTrial(c3dobj)
+    trial = GaitTrial(c3dobj, channels=channels, NoPointSamples=NoPointSamples, normalisation=normalisation,
+        allcycles=allcycles, lazy=lazy, profile=profiler if profile else None, dtype=dtype)
 
     return trial
 
+def ScanTrialMetadata(path):
+    """
+    Reads the events and channel classification of a trial without decoding the point and analog data.
+
+    :param path(string): Absolute or relative path to the c3d file
+    :return: trial(TrialMetadata): Events and channel labels of the trial
+    """
+    return TrialMetadata(ReadC3DMetadata(path))
+
+def StreamTrialEMG(path, cycle=None, labels=None, envelope=True, **kwargs):
+    """
+    Streams the EMG of a c3d file from a memory map, without holding the recording in memory.
+
+    :param path(string): Absolute or relative path to the c3d file
+    :param cycle(string)(optional): 'Left', 'Right', 'Full' or None for the whole recording
+    :param labels(list)(optional): EMG channels to process, all channels by default
+    :param envelope(bool)(optional): Stream linear envelopes (StreamEnvelopeEMG), otherwise resampled EMG (StreamMSAInputData)
+    :param kwargs: Passed on to StreamEnvelopeEMG or StreamMSAInputData
+    :return: trial(TrialMetadata), blocks(generator): Trial events and labels, and the processed blocks
+    """
+    c3dobj = MappedC3D(path)
+    trial = TrialMetadata(c3dobj)
+    analogs = c3dobj['data']['analogs'][0]
+
+    if envelope:
+        blocks = trial.StreamEnvelopeEMG(analogs, cycle=cycle, labels=labels, **kwargs)
+    else:
+        blocks = trial.StreamMSAInputData(analogs, labels, cycle=cycle, **kwargs)
+    return trial, blocks
+
 
 
 # path = "C:\Development_projects\__EXAMPLE_FILES\C3D\gait_2.c3d"
@@ -4,6 +4,7 @@ import json
 from scipy import signal
 
 import pickle
+from functools import lru_cache
 
 
 def pull_events(trial):
@@ -381,6 +382,11 @@ def data_export_filename(dataset, outputdirectory, subjectref, trialno, cycle):
     return filepath
 
 ############# EMG preprocessing for MSA
+@lru_cache(maxsize=32)
+def butter_coefficients(order, w, btype):
+    # Filter design is the same for every channel of a trial so only do it once
+    return signal.butter(order, w, btype)
+
 def prepare_emg_MSA(array, fs):
 
     downsample_rate = 100 #hz
@@ -397,14 +403,14 @@ def prepare_emg_MSA(array, fs):
     lp_w = lp_fc/(fs/2)
 
     # High pass filter
-    hp_b, hp_a = signal.butter(order, hp_w, 'high')
+    hp_b, hp_a = butter_coefficients(order, hp_w, 'high')
     hp_array = signal.filtfilt(hp_b, hp_a, array)
 
     # Full wave Rectification
     fwr_array = abs(hp_array)
 
     # LP filter
-    lp_b, lp_a = signal.butter(order, lp_w, 'low')
+    lp_b, lp_a = butter_coefficients(order, lp_w, 'low')
     lp_array = signal.filtfilt(lp_b, lp_a, fwr_array)
 
     # Normalise signal
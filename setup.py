@@ -11,15 +11,21 @@ setup(
     version='1.1.0',
     description='Extracts gait data from C3D files',
     #packages=['gpscalc'],
-    py_modules=["c3dtrial"],
+    py_modules=["c3dtrial", "c3dreader", "c3dbatch", "c3dstore", "c3dcache", "c3dgps", "c3dindex"],
     package_dir={'':'c3dgait'},
     setup_requires=['wheel'],
+    entry_points={
+        'console_scripts': ['c3dbatch=c3dbatch:main', 'c3dindex=c3dindex:main'],
+    },
     classifiers=[
         #"License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
     ],
     #install_requires=requirements,
+    extras_require={
+        'store': ['h5py'],
+    },
     long_description=open('README.md').read(),
 )
 